@@ -0,0 +1,105 @@
+# auth0.py
+import os
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import response_hook, METRICS_ENABLED
+
+AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
+AUTH0_BASE_URL = os.getenv("AUTH0_BASE_URL", f"https://{AUTH0_DOMAIN}").rstrip('/')
+CLIENT_ID = os.getenv("AUTH0_CLIENT_ID")
+CLIENT_SECRET = os.getenv("AUTH0_CLIENT_SECRET")
+
+AUTH0_CONNECT_TIMEOUT = float(os.getenv("AUTH0_CONNECT_TIMEOUT", "3.05"))
+AUTH0_READ_TIMEOUT = float(os.getenv("AUTH0_READ_TIMEOUT", "10"))
+AUTH0_POOL_SIZE = int(os.getenv("AUTH0_POOL_SIZE", "10"))
+AUTH0_MAX_RETRIES = int(os.getenv("AUTH0_MAX_RETRIES", "2"))
+AUTH0_RETRY_BACKOFF = float(os.getenv("AUTH0_RETRY_BACKOFF", "0.3"))
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    # One keep-alive session per process. Only connection failures are
+    # retried: a token request that reached Auth0 is never resent, whatever
+    # came back (a 5xx is left to the caller) or if the read timed out.
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(total=AUTH0_MAX_RETRIES, connect=AUTH0_MAX_RETRIES, read=0,
+                          status=0, backoff_factor=AUTH0_RETRY_BACKOFF)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AUTH0_POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.headers.update({'content-type': 'application/json'})
+            if METRICS_ENABLED:
+                session.hooks['response'].append(response_hook('auth0'))
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+class SingleFlight:
+    # Collapses concurrent calls with the same key into one; every caller
+    # gets the first caller's result (or exception)
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+
+        if not leader:
+            call["done"].wait()
+        else:
+            try:
+                call["result"] = fn()
+            except Exception as e:
+                call["error"] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call["done"].set()
+
+        if "error" in call:
+            raise call["error"]
+        return call["result"]
+
+
+_login_flight = SingleFlight()
+
+
+def request_token(username, password, domain=None, client_id=None, client_secret=None):
+    # Resource-owner password grant against Auth0. Returns (status, body).
+    # Raises requests.RequestException if Auth0 can't be reached in time.
+    base_url = f'https://{domain}' if domain else AUTH0_BASE_URL
+    payload = {
+        "grant_type": "password",
+        "username": username,
+        "password": password,
+        "client_id": client_id or CLIENT_ID,
+        "client_secret": client_secret or CLIENT_SECRET,
+        "scope": "openid profile email"
+    }
+
+    def call():
+        resp = get_session().post(f'{base_url}/oauth/token', json=payload,
+                                  timeout=(AUTH0_CONNECT_TIMEOUT, AUTH0_READ_TIMEOUT))
+        try:
+            body = resp.json()
+        except ValueError:
+            body = {}
+        return resp.status_code, body
+
+    # Identical credentials submitted concurrently share one upstream call;
+    # the key is a digest so credentials are never held as dict keys
+    key = hashlib.sha256(f"{base_url}\0{username}\0{password}".encode()).hexdigest()
+    return _login_flight.do(key, call)
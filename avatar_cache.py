@@ -0,0 +1,186 @@
+# avatar_cache.py
+import os
+import time
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from metrics import AVATAR_CACHE_EVENTS, AVATAR_CACHE_SERVED_BYTES, AVATAR_CACHE_BYTES
+
+# Memory tier: small, hot images
+AVATAR_MEMORY_CACHE_BYTES = int(os.getenv("AVATAR_MEMORY_CACHE_BYTES", str(16 * 1024 * 1024)))
+AVATAR_MEMORY_ITEM_MAX = int(os.getenv("AVATAR_MEMORY_ITEM_MAX", str(64 * 1024)))
+# Disk tier: everything else, served with sendfile
+AVATAR_DISK_CACHE_DIR = os.getenv("AVATAR_DISK_CACHE_DIR",
+                                  os.path.join(tempfile.gettempdir(), "tarpaulin-avatars"))
+AVATAR_DISK_CACHE_BYTES = int(os.getenv("AVATAR_DISK_CACHE_BYTES", str(256 * 1024 * 1024)))
+# Seconds an entry is served without asking GCS whether it changed
+AVATAR_CACHE_FRESHNESS = int(os.getenv("AVATAR_CACHE_FRESHNESS", "30"))
+
+# data is set for memory entries, path for disk entries
+CacheEntry = namedtuple('CacheEntry', ['generation', 'size', 'data', 'path', 'checked_at'])
+
+
+class AvatarCache:
+    # Two-tier read-through cache for avatar blobs, keyed by blob name and
+    # validated by blob generation. Each worker process owns its own tiers.
+    def __init__(self, memory_bytes=AVATAR_MEMORY_CACHE_BYTES,
+                 memory_item_max=AVATAR_MEMORY_ITEM_MAX,
+                 disk_dir=AVATAR_DISK_CACHE_DIR, disk_bytes=AVATAR_DISK_CACHE_BYTES,
+                 freshness=AVATAR_CACHE_FRESHNESS):
+        self.memory_bytes = memory_bytes
+        self.memory_item_max = memory_item_max
+        self.disk_root = disk_dir
+        self.disk_bytes = disk_bytes
+        self.freshness = freshness
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = 0
+        self._disk_dir = None
+        self._disk_dir_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.bytes_served = 0
+        self._update_gauges()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def disk_dir(self):
+        # Per-process directory, emptied the first time it is used. Request
+        # threads race to get here, so only one may empty and create it:
+        # a second rmtree would delete files the first already cached.
+        if self._disk_dir is None and self.disk_root and self.disk_bytes > 0:
+            with self._disk_dir_lock:
+                if self._disk_dir is None:
+                    path = os.path.join(self.disk_root, str(os.getpid()))
+                    shutil.rmtree(path, ignore_errors=True)
+                    os.makedirs(path, exist_ok=True)
+                    self._disk_dir = path
+        return self._disk_dir
+
+    def accepts(self, size):
+        # Whether an object of this size can be cached at all
+        if size <= self.memory_item_max and self.memory_bytes > 0:
+            return True
+        return self.disk_dir() is not None and size <= self.disk_bytes
+
+    def get(self, name):
+        self._check_pid()
+        with self._lock:
+            for tier in (self._memory, self._disk):
+                entry = tier.get(name)
+                if entry is not None:
+                    tier.move_to_end(name)
+                    return entry
+        return None
+
+    def is_fresh(self, entry):
+        return time.monotonic() - entry.checked_at < self.freshness
+
+    def touch(self, name):
+        # GCS confirmed the cached generation is still current
+        with self._lock:
+            self.revalidations += 1
+            for tier, label in ((self._memory, 'memory'), (self._disk, 'disk')):
+                entry = tier.get(name)
+                if entry is not None:
+                    tier[name] = entry._replace(checked_at=time.monotonic())
+                    AVATAR_CACHE_EVENTS.labels(label, 'revalidation').inc()
+
+    def record_hit(self, entry):
+        tier = 'memory' if entry.data is not None else 'disk'
+        AVATAR_CACHE_EVENTS.labels(tier, 'hit').inc()
+        AVATAR_CACHE_SERVED_BYTES.labels(tier).inc(entry.size)
+        with self._lock:
+            self.hits += 1
+            self.bytes_served += entry.size
+
+    def record_miss(self):
+        AVATAR_CACHE_EVENTS.labels('none', 'miss').inc()
+        with self._lock:
+            self.misses += 1
+
+    def put_bytes(self, name, generation, data):
+        self._check_pid()
+        entry = CacheEntry(generation, len(data), data, None, time.monotonic())
+        with self._lock:
+            self._drop(name)
+            self._memory[name] = entry
+            self._memory_used += entry.size
+            while self._memory_used > self.memory_bytes and self._memory:
+                _, old = self._memory.popitem(last=False)
+                self._memory_used -= old.size
+            self._update_gauges()
+
+    def put_file(self, name, generation, tmp_path):
+        # Adopt a fully written temp file (inside disk_dir()) into the disk tier
+        self._check_pid()
+        size = os.path.getsize(tmp_path)
+        path = os.path.join(self.disk_dir(), f"{name.replace('/', '_')}.{generation}")
+        os.replace(tmp_path, path)
+        entry = CacheEntry(generation, size, None, path, time.monotonic())
+        with self._lock:
+            self._drop(name)
+            self._disk[name] = entry
+            self._disk_used += size
+            while self._disk_used > self.disk_bytes and self._disk:
+                _, old = self._disk.popitem(last=False)
+                self._disk_used -= old.size
+                self._unlink(old.path)
+            self._update_gauges()
+
+    def invalidate(self, name):
+        self._check_pid()
+        with self._lock:
+            self._drop(name)
+            self._update_gauges()
+
+    def _update_gauges(self):
+        AVATAR_CACHE_BYTES.labels('memory').set(self._memory_used)
+        AVATAR_CACHE_BYTES.labels('disk').set(self._disk_used)
+
+    def _drop(self, name):
+        entry = self._memory.pop(name, None)
+        if entry is not None:
+            self._memory_used -= entry.size
+        entry = self._disk.pop(name, None)
+        if entry is not None:
+            self._disk_used -= entry.size
+            self._unlink(entry.path)
+
+    @staticmethod
+    def _unlink(path):
+        # Readers that already opened the file keep their handle
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "revalidations": self.revalidations,
+                "bytes_served": self.bytes_served,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_used
+            }
+
+
+avatar_cache = AvatarCache()
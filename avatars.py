@@ -0,0 +1,478 @@
+# avatars.py
+import io
+import os
+import time
+import datetime
+import tempfile
+import threading
+import contextvars
+from urllib.parse import quote, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, jsonify, redirect, request, send_file
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import Signing
+from google.auth.transport.requests import Request as AuthRequest
+from PIL import Image, ImageOps, UnidentifiedImageError
+from avatar_cache import avatar_cache
+from clients import get_media_session, get_credentials
+from metrics import record_external
+
+AVATAR_CHUNK_SIZE = int(os.getenv("AVATAR_CHUNK_SIZE", str(64 * 1024)))
+AVATAR_MAX_AGE = int(os.getenv("AVATAR_MAX_AGE", "300"))
+AVATAR_DOWNLOAD_TIMEOUT = float(os.getenv("AVATAR_DOWNLOAD_TIMEOUT", "10"))
+# Upload processing
+AVATAR_SIZES = sorted(int(size) for size in os.getenv("AVATAR_SIZES", "32,128,512").split(','))
+AVATAR_MAX_DIMENSION = int(os.getenv("AVATAR_MAX_DIMENSION", "1024"))
+AVATAR_MAX_UPLOAD_BYTES = int(os.getenv("AVATAR_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+AVATAR_UPLOAD_WORKERS = int(os.getenv("AVATAR_UPLOAD_WORKERS", "4"))
+# "proxy" streams avatar bytes through the app; "redirect" sends clients
+# to a short-lived V4 signed URL instead
+AVATAR_SERVING_MODE = os.getenv("AVATAR_SERVING_MODE", "proxy")
+AVATAR_SIGNED_URL_TTL = int(os.getenv("AVATAR_SIGNED_URL_TTL", "900"))
+AVATAR_SIGNED_URL_MARGIN = int(os.getenv("AVATAR_SIGNED_URL_MARGIN", "60"))
+# Optional service account key used for signing (e.g. against a local GCS
+# stand-in); otherwise the client's credentials or IAM signBlob are used
+AVATAR_SIGNING_CREDENTIALS = os.getenv("AVATAR_SIGNING_CREDENTIALS")
+AVATAR_SIGNING_SERVICE_ACCOUNT = os.getenv("AVATAR_SIGNING_SERVICE_ACCOUNT")
+AVATAR_SIGNING_ENDPOINT = os.getenv("AVATAR_SIGNING_ENDPOINT")
+
+ACCEPTED_FORMATS = {'PNG', 'JPEG', 'GIF', 'WEBP'}
+# Variant formats: file extension -> (Pillow format, content type)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'png': ('PNG', 'image/png')
+}
+
+# Refuse images that would decode to more than this many pixels
+Image.MAX_IMAGE_PIXELS = int(os.getenv("AVATAR_MAX_PIXELS", str(40 * 1000 * 1000)))
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def avatar_blob_name(user_id):
+    return f'avatars/{user_id}.png'
+
+
+def variant_blob_name(user_id, size, ext):
+    return f'avatars/{user_id}/{size}.{ext}'
+
+
+def staged_blob_name(user_id):
+    # Target of signed uploads, processed by POST /users/:id/avatar/complete
+    return f'avatars/incoming/{user_id}'
+
+
+def all_avatar_blob_names(user_id):
+    names = [avatar_blob_name(user_id)]
+    for size in AVATAR_SIZES:
+        names += [variant_blob_name(user_id, size, ext) for ext in VARIANT_FORMATS]
+    return names
+
+
+def variant_key(size, ext):
+    # Property name for a variant's generation in the avatar metadata
+    return f'{ext}_{size}'
+
+
+def pick_variant(user_id, requested_size, accept_header):
+    # Smallest pre-generated size that still covers the requested one,
+    # as WebP when the client accepts it
+    size = next((s for s in AVATAR_SIZES if s >= requested_size), AVATAR_SIZES[-1])
+    ext = 'webp' if 'image/webp' in (accept_header or '') else 'png'
+    return variant_blob_name(user_id, size, ext), VARIANT_FORMATS[ext][1], variant_key(size, ext)
+
+
+def avatar_metadata(original, variants):
+    # What the users entity records about a stored avatar. `original` is
+    # the loaded blob (or stored object) for avatars/{id}.png; `variants`
+    # maps variant_key() to loaded variant blobs.
+    return {
+        "generation": int(original.generation),
+        "size": int(original.size),
+        "content_type": original.content_type,
+        "updated": original.updated,
+        "variants": {key: int(blob.generation) for key, blob in variants.items()}
+    }
+
+
+def make_etag(generation):
+    # Generations change on every overwrite, so they make strong validators
+    return f'"{generation}"'
+
+
+def parse_if_none_match(header):
+    # Return the generation named by an If-None-Match header we issued
+    for tag in (header or '').split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag.isdigit():
+            return int(tag)
+    return None
+
+
+def open_avatar(bucket, name, range_header=None, if_generation_not_match=None):
+    # Issue a single streaming media request to the GCS JSON API. The
+    # response carries the object's metadata headers, so no separate
+    # exists()/reload() call is needed; a missing object comes back as a 404.
+    params = {'alt': 'media'}
+    if if_generation_not_match is not None:
+        params['ifGenerationNotMatch'] = if_generation_not_match
+    url = (f"{bucket.client.api_endpoint}/download/storage/v1/b/{quote(bucket.name, safe='')}"
+           f"/o/{quote(name, safe='')}?{urlencode(params)}")
+    headers = {}
+    if range_header:
+        headers['Range'] = range_header
+    return get_media_session().get(url, headers=headers, stream=True,
+                                   timeout=AVATAR_DOWNLOAD_TIMEOUT)
+
+
+def _iter_body(resp):
+    try:
+        for chunk in resp.iter_content(AVATAR_CHUNK_SIZE):
+            yield chunk
+    finally:
+        resp.close()
+
+
+def _iter_and_fill(resp, name, generation, size):
+    # Relay the body to the client while copying it into the cache. The
+    # entry is only kept if the whole object made it through.
+    if size <= avatar_cache.memory_item_max and avatar_cache.memory_bytes > 0:
+        sink, tmp_path = io.BytesIO(), None
+    else:
+        fd, tmp_path = tempfile.mkstemp(dir=avatar_cache.disk_dir())
+        sink = os.fdopen(fd, 'wb')
+
+    written = 0
+    try:
+        for chunk in resp.iter_content(AVATAR_CHUNK_SIZE):
+            sink.write(chunk)
+            written += len(chunk)
+            yield chunk
+    finally:
+        resp.close()
+        if tmp_path is None:
+            if written == size:
+                avatar_cache.put_bytes(name, generation, sink.getvalue())
+        else:
+            sink.close()
+            if written == size:
+                avatar_cache.put_file(name, generation, tmp_path)
+            else:
+                os.remove(tmp_path)
+
+
+def send_avatar(source, user_id, mimetype, generation):
+    # Answer from bytes (or a file) we already hold, honoring
+    # If-None-Match and Range
+    rv = send_file(source, mimetype=mimetype, as_attachment=False,
+                   download_name=f'user_{user_id}_avatar.{mimetype.split("/")[1]}',
+                   etag=str(generation), conditional=True,
+                   max_age=AVATAR_MAX_AGE)
+    rv.headers['Cache-Control'] = f'private, max-age={AVATAR_MAX_AGE}'
+    return rv
+
+
+def _send_cached(entry, user_id, mimetype):
+    source = io.BytesIO(entry.data) if entry.data is not None else entry.path
+    rv = send_avatar(source, user_id, mimetype, entry.generation)
+    avatar_cache.record_hit(entry)
+    return rv
+
+
+def _relay(resp, user_id, mimetype, cache_name=None, client_generation=None):
+    # Turn a GCS media response into our response, filling the cache
+    # from full 200 bodies when cache_name is given
+    if resp.status_code == 404:
+        resp.close()
+        return jsonify({"Error": "Not found"}), 404
+
+    headers = {
+        'Cache-Control': f'private, max-age={AVATAR_MAX_AGE}',
+        'Accept-Ranges': 'bytes'
+    }
+
+    if resp.status_code == 304:
+        resp.close()
+        headers['ETag'] = make_etag(client_generation)
+        return Response(status=304, headers=headers)
+
+    if resp.status_code == 416:
+        resp.close()
+        headers['Content-Range'] = resp.headers.get('Content-Range', 'bytes */*')
+        return Response(status=416, headers=headers)
+
+    resp.raise_for_status()
+
+    generation = resp.headers['X-Goog-Generation']
+    headers['ETag'] = make_etag(generation)
+    headers['Content-Disposition'] = f'inline; filename=user_{user_id}_avatar.{mimetype.split("/")[1]}'
+    for name in ('Content-Length', 'Content-Range'):
+        if name in resp.headers:
+            headers[name] = resp.headers[name]
+
+    body = _iter_body(resp)
+    size = resp.headers.get('Content-Length')
+    if cache_name and resp.status_code == 200 and size and avatar_cache.accepts(int(size)):
+        body = _iter_and_fill(resp, cache_name, int(generation), int(size))
+
+    return Response(body, status=resp.status_code, headers=headers,
+                    mimetype=mimetype, direct_passthrough=True)
+
+
+def stream_avatar(bucket, user_id, name=None, mimetype='image/png', generation=None):
+    # Serve the avatar from the local cache when possible, otherwise
+    # stream it from GCS in chunks, honoring If-None-Match and Range.
+    # `generation` is the current generation if the caller knows it (from
+    # the user's avatar metadata), which spares GCS revalidation.
+    name = name or avatar_blob_name(user_id)
+
+    if generation is not None and parse_if_none_match(request.headers.get('If-None-Match')) == generation:
+        return Response(status=304, headers={
+            'ETag': make_etag(generation),
+            'Cache-Control': f'private, max-age={AVATAR_MAX_AGE}'
+        })
+
+    entry = avatar_cache.get(name)
+    if entry is not None and generation is not None and entry.generation != generation:
+        avatar_cache.invalidate(name)
+        entry = None
+
+    if entry is not None:
+        if generation is None and not avatar_cache.is_fresh(entry):
+            # Cheap revalidation: GCS answers 304 without a body if unchanged
+            resp = open_avatar(bucket, name, if_generation_not_match=entry.generation)
+            if resp.status_code != 304:
+                avatar_cache.invalidate(name)
+                return _relay(resp, user_id, mimetype, cache_name=name)
+            resp.close()
+            avatar_cache.touch(name)
+        try:
+            return _send_cached(entry, user_id, mimetype)
+        except OSError:
+            avatar_cache.invalidate(name)  # evicted from disk meanwhile
+
+    avatar_cache.record_miss()
+    generation = parse_if_none_match(request.headers.get('If-None-Match'))
+    range_header = request.headers.get('Range')
+    resp = open_avatar(bucket, name, range_header=range_header,
+                       if_generation_not_match=generation)
+    # Partial reads are passed through without filling the cache
+    return _relay(resp, user_id, mimetype, cache_name=None if range_header else name,
+                  client_generation=generation)
+
+
+def invalidate_avatar(user_id):
+    for name in all_avatar_blob_names(user_id):
+        avatar_cache.invalidate(name)
+        signed_url_cache.invalidate(('GET', name))
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # Thread pool for concurrent GCS writes, rebuilt after a fork
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=AVATAR_UPLOAD_WORKERS,
+                                           thread_name_prefix='avatar')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _submit(fn, *args):
+    # Carry the request's context variables (its metrics) into the pool
+    return get_executor().submit(contextvars.copy_context().run, fn, *args)
+
+
+def load_image(stream):
+    # Decode straight from the upload stream; Pillow reads it incrementally
+    try:
+        image = Image.open(stream)
+        if image.format not in ACCEPTED_FORMATS:
+            raise InvalidImage(f"unsupported format {image.format}")
+        image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise InvalidImage(str(e))
+
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGBA')
+
+
+def _encode(image, fmt):
+    out = io.BytesIO()
+    if fmt == 'WEBP':
+        image.save(out, fmt, quality=85, method=4)
+    else:
+        image.save(out, fmt, optimize=True)
+    return out.getvalue()
+
+
+def gcs_writer(bucket):
+    # write(name, data, content_type) for process_and_upload_avatar; the
+    # uploaded blob carries the generation/size/content_type/updated fields
+    # avatar_metadata() reads
+    def write(name, data, content_type):
+        blob = bucket.blob(name)
+        start = time.perf_counter()
+        try:
+            blob.upload_from_string(data, content_type=content_type)
+        finally:
+            record_external('gcs', time.perf_counter() - start)
+        return blob
+    return write
+
+
+def _write_variant(write, name, image, ext):
+    fmt, content_type = VARIANT_FORMATS[ext]
+    return write(name, _encode(image, fmt), content_type)
+
+
+def process_and_upload_avatar(write, user_id, stream):
+    # Validate the upload, then write a normalized PNG original plus square
+    # WebP/PNG variants for every AVATAR_SIZES entry. `write` stores one
+    # encoded image (see gcs_writer). Returns the avatar metadata to store
+    # on the user.
+    image = load_image(stream)
+    image.thumbnail((AVATAR_MAX_DIMENSION, AVATAR_MAX_DIMENSION), Image.LANCZOS)
+
+    # PIL images aren't safe to share between threads, so the resizes run
+    # here, one per size, and every encode/upload task gets its own copy
+    resized = {size: ImageOps.fit(image, (size, size), Image.LANCZOS) for size in AVATAR_SIZES}
+    original = _submit(_write_variant, write, avatar_blob_name(user_id), image, 'png')
+    variants = {}
+    for size, sized in resized.items():
+        for ext in VARIANT_FORMATS:
+            variants[variant_key(size, ext)] = _submit(
+                _write_variant, write, variant_blob_name(user_id, size, ext), sized.copy(), ext)
+    return avatar_metadata(original.result(),
+                           {key: future.result() for key, future in variants.items()})
+
+
+def _delete_blob(bucket, name):
+    start = time.perf_counter()
+    try:
+        bucket.blob(name).delete()
+        return True
+    except NotFound:
+        return False
+    finally:
+        record_external('gcs', time.perf_counter() - start)
+
+
+def delete_avatar_blobs(bucket, user_id):
+    # Delete the original and all variants; False if there was no avatar
+    futures = [_submit(_delete_blob, bucket, name)
+               for name in all_avatar_blob_names(user_id)]
+    results = [future.result() for future in futures]
+    return results[0]
+
+
+class SignedURLCache:
+    # Reuses signed URLs until shortly before they expire
+    def __init__(self, margin=AVATAR_SIGNED_URL_MARGIN):
+        self.margin = margin
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry[1] - self.margin:
+            return None
+        return entry[0], int(entry[1] - time.monotonic())
+
+    def put(self, key, url, ttl):
+        with self._lock:
+            self._entries[key] = (url, time.monotonic() + ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+signed_url_cache = SignedURLCache()
+_signing_credentials = None
+
+
+def _signing_kwargs():
+    global _signing_credentials
+    kwargs = {}
+    if AVATAR_SIGNING_ENDPOINT:
+        kwargs['api_access_endpoint'] = AVATAR_SIGNING_ENDPOINT
+    if AVATAR_SIGNING_CREDENTIALS:
+        if _signing_credentials is None:
+            from google.oauth2 import service_account
+            _signing_credentials = service_account.Credentials.from_service_account_file(
+                AVATAR_SIGNING_CREDENTIALS)
+        kwargs['credentials'] = _signing_credentials
+        return kwargs
+
+    # The credentials the Storage client was built with
+    credentials = get_credentials()
+    if credentials is None or isinstance(credentials, Signing):
+        return kwargs
+
+    # App Engine/Compute credentials hold no private key; sign through IAM
+    if not credentials.valid:
+        credentials.refresh(AuthRequest())
+    kwargs['service_account_email'] = (AVATAR_SIGNING_SERVICE_ACCOUNT
+                                       or credentials.service_account_email)
+    kwargs['access_token'] = credentials.token
+    return kwargs
+
+
+def signed_url(bucket, name, method='GET', content_type=None, headers=None):
+    # V4 signed URL for one blob; GET URLs are cached per blob
+    key = (method, name)
+    if method == 'GET':
+        cached = signed_url_cache.get(key)
+        if cached is not None:
+            return cached
+
+    url = bucket.blob(name).generate_signed_url(
+        version='v4',
+        expiration=datetime.timedelta(seconds=AVATAR_SIGNED_URL_TTL),
+        method=method,
+        content_type=content_type,
+        headers=headers,
+        **_signing_kwargs()
+    )
+    if method == 'GET':
+        signed_url_cache.put(key, url, AVATAR_SIGNED_URL_TTL)
+    return url, AVATAR_SIGNED_URL_TTL
+
+
+def redirect_to_avatar(bucket, name):
+    # 307 to a signed URL; clients may reuse the redirect until it nears expiry
+    url, expires_in = signed_url(bucket, name)
+    rv = redirect(url, code=307)
+    rv.headers['Cache-Control'] = f'private, max-age={max(expires_in - AVATAR_SIGNED_URL_MARGIN, 0)}'
+    return rv
+
+
+def signed_upload(bucket, user_id, content_type):
+    # Signed PUT for the staging blob; GCS enforces type and size limits
+    headers = {'x-goog-content-length-range': f'0,{AVATAR_MAX_UPLOAD_BYTES}'}
+    url, expires_in = signed_url(bucket, staged_blob_name(user_id), method='PUT',
+                                 content_type=content_type, headers=dict(headers))
+    headers['Content-Type'] = content_type
+    return url, headers, expires_in
+
+
+def process_staged_upload(bucket, user_id):
+    # Run the upload pipeline on a blob the client PUT to GCS directly.
+    # Raises NotFound if nothing was uploaded.
+    blob = bucket.blob(staged_blob_name(user_id))
+    with blob.open('rb', chunk_size=1024 * 1024) as stream:
+        metadata = process_and_upload_avatar(gcs_writer(bucket), user_id, stream)
+    _delete_blob(bucket, blob.name)
+    return metadata
@@ -0,0 +1,3 @@
+# benchmark
+#
+# Load-test harness; see benchmark/run.py and the README's Benchmarks section.
@@ -0,0 +1,12 @@
+# benchmark/app.py
+#
+# gunicorn entry point (benchmark.app:app). With the memory backend the
+# dataset is generated here; under --preload that happens once in the
+# master, so every worker forks with identical data.
+from repositories import get_repositories, STORAGE_BACKEND
+from benchmark.data import generate, params_from_env
+
+if STORAGE_BACKEND == 'memory':
+    generate(get_repositories(), **params_from_env())
+
+from main import app
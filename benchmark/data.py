@@ -0,0 +1,70 @@
+# benchmark/data.py
+#
+# Synthetic users, courses and enrollments. Generation is deterministic:
+# the same parameters produce the same ids and rosters on every backend
+# that allocates ids sequentially (memory, sqlite).
+import os
+import random
+from collections import namedtuple
+
+SUBJECTS = ['ART', 'BIO', 'CHEM', 'CS', 'ECON', 'HIST', 'MATH', 'PHYS', 'PSY', 'STAT']
+TERMS = ['fall-24', 'winter-25', 'spring-25', 'summer-25']
+
+Dataset = namedtuple('Dataset', ['admins', 'instructors', 'students', 'courses'])
+
+
+def user_sub(user_id):
+    return f'benchmark|{user_id}'
+
+
+def params_from_env():
+    return {
+        "users": int(os.getenv("BENCH_USERS", "1000")),
+        "courses": int(os.getenv("BENCH_COURSES", "200")),
+        "students_per_course": int(os.getenv("BENCH_STUDENTS_PER_COURSE", "25")),
+        "seed": int(os.getenv("BENCH_SEED", "1"))
+    }
+
+
+def params_to_env(users, courses, students_per_course, seed):
+    return {
+        "BENCH_USERS": str(users),
+        "BENCH_COURSES": str(courses),
+        "BENCH_STUDENTS_PER_COURSE": str(students_per_course),
+        "BENCH_SEED": str(seed)
+    }
+
+
+def generate(repos, users=1000, courses=200, students_per_course=25, seed=1):
+    # One admin, one instructor per 20 users, students for the rest
+    rng = random.Random(seed)
+    n_instructors = max(1, users // 20)
+    admins = [1]
+    instructors = list(range(2, n_instructors + 2))
+    students = list(range(n_instructors + 2, max(users, n_instructors + 2) + 1))
+
+    for role, user_ids in (('admin', admins), ('instructor', instructors), ('student', students)):
+        for user_id in user_ids:
+            repos.users.create({"id": user_id, "sub": user_sub(user_id), "role": role})
+
+    course_records = []
+    for n in range(courses):
+        course_records.append(repos.courses.create({
+            "subject": rng.choice(SUBJECTS),
+            "number": rng.randint(100, 599),
+            "title": f"Course {n}",
+            "term": rng.choice(TERMS),
+            "instructor_id": rng.choice(instructors)
+        }))
+
+    # Rosters go in through the same path as PATCH /courses/students
+    per_course = min(students_per_course, len(students))
+    chunk = max(1, 400 // max(per_course, 1))
+    for start in range(0, len(course_records), chunk):
+        changes = {c['id']: (rng.sample(students, per_course), [])
+                   for c in course_records[start:start + chunk]}
+        if per_course:
+            repos.enrollments.apply(changes)
+
+    return Dataset(admins, instructors, students,
+                   [(c['id'], c['subject'], c['instructor_id']) for c in course_records])
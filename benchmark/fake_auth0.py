@@ -0,0 +1,102 @@
+# benchmark/fake_auth0.py
+#
+# Local stand-in for the Auth0 tenant: serves the JWKS of a freshly
+# generated RS256 key and answers password grants with tokens signed by it.
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+KID = 'benchmark'
+PASSWORD = 'benchmark'
+
+
+class FakeAuth0:
+    def __init__(self, audience, host='127.0.0.1', port=0, token_ttl=3600):
+        self.audience = audience
+        self.token_ttl = token_ttl
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = key.private_bytes(serialization.Encoding.PEM,
+                                             serialization.PrivateFormat.PKCS8,
+                                             serialization.NoEncryption())
+        public_pem = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                   serialization.PublicFormat.SubjectPublicKeyInfo)
+        public = jwk.construct(public_pem, 'RS256').to_dict()
+        public.update(kid=KID, use='sig', alg='RS256')
+        self.jwks = json.dumps({"keys": [public]}).encode()
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def token(self, sub):
+        # One token per subject, reused like a real client would
+        with self._lock:
+            token = self._tokens.get(sub)
+            if token is None:
+                now = int(time.time())
+                token = jwt.encode({
+                    "sub": sub,
+                    "iss": f'{self.base_url}/',
+                    "aud": self.audience,
+                    "iat": now,
+                    "exp": now + self.token_ttl
+                }, self.private_pem, algorithm='RS256', headers={"kid": KID})
+                self._tokens[sub] = token
+            return token
+
+    def _handler(self):
+        issuer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _send(self, status, body, headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/.well-known/jwks.json':
+                    self._send(200, issuer.jwks, {'Cache-Control': 'public, max-age=86400'})
+                else:
+                    self._send(404, b'{}')
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    body = {}
+                if self.path != '/oauth/token':
+                    self._send(404, b'{}')
+                elif body.get('password') != PASSWORD or not body.get('username'):
+                    self._send(403, json.dumps({"error": "invalid_grant"}).encode())
+                else:
+                    token = issuer.token(body['username'])
+                    self._send(200, json.dumps({"id_token": token, "token_type": "Bearer"}).encode())
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
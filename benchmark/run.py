@@ -0,0 +1,237 @@
+# benchmark/run.py
+#
+# Starts the app under gunicorn against local stand-ins (a fake Auth0
+# issuer and the memory/sqlite backends, or the Datastore emulator), drives
+# a weighted mix of requests at fixed concurrency and reports throughput
+# and latency percentiles per route.
+#
+#   python -m benchmark.run --mix mixed --concurrency 16 --duration 30
+#
+# Results are saved as JSON; pass --compare to diff against an earlier run.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUDIENCE = 'benchmark'
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Load-test the Tarpaulin API")
+    parser.add_argument('--mix', default='mixed', help="read, mixed, search, batch, write or auth")
+    parser.add_argument('--backend', default='memory', choices=['memory', 'sqlite', 'datastore'],
+                        help="datastore needs DATASTORE_EMULATOR_HOST")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=3, help="unmeasured seconds first")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--threads', type=int, help="gunicorn threads per worker (default: gunicorn.conf.py)")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--courses', type=int, default=200)
+    parser.add_argument('--students-per-course', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--output', default=os.path.join(ROOT, 'benchmark', 'results'),
+                        help="directory for the JSON results")
+    parser.add_argument('--compare', help="earlier results file to compare with")
+    return parser.parse_args(argv)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def prepare_storage(args, env):
+    # Generate the dataset in this process. For memory this is a private
+    # copy used only to learn the ids; the server builds its own.
+    os.environ.update(env)
+    from repositories import make_repositories
+    from benchmark.data import generate
+    return generate(make_repositories(args.backend), users=args.users, courses=args.courses,
+                    students_per_course=args.students_per_course, seed=args.seed)
+
+
+def start_server(args, env):
+    cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--preload',
+           '-w', str(args.workers), '-b', f'127.0.0.1:{args.port}', '--log-level', 'warning']
+    if args.threads:
+        cmd += ['--threads', str(args.threads)]
+    cmd.append('benchmark.app:app')
+    server = subprocess.Popen(cmd, cwd=ROOT, env=dict(os.environ, **env))
+    base_url = f'http://127.0.0.1:{args.port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        try:
+            if requests.get(f'{base_url}/', timeout=1).status_code == 200:
+                return server, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not become ready")
+
+
+def drive(base_url, ctx, choose, concurrency, duration, seed):
+    # Closed loop: each client sends its next request as soon as the
+    # previous one returns
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(n):
+        rng = random.Random(seed * 1000 + n)
+        session = requests.Session()
+        local = []
+        while time.monotonic() < deadline:
+            route, method, path, headers, body = choose(rng)(ctx, rng)
+            start = time.perf_counter()
+            try:
+                resp = session.request(method, base_url + path, headers=headers, json=body, timeout=30)
+                resp.content
+                ok = resp.status_code < 400
+            except requests.RequestException:
+                ok = False
+            local.append((route, time.perf_counter() - start, ok))
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.monotonic() - started
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(samples, elapsed):
+    routes = {}
+    for route, latency, ok in samples:
+        entry = routes.setdefault(route, {"latencies": [], "errors": 0})
+        entry["latencies"].append(latency)
+        if not ok:
+            entry["errors"] += 1
+
+    def stats(latencies, errors):
+        latencies.sort()
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / elapsed, 2),
+            "mean_ms": round(1000 * sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            "p50_ms": round(1000 * percentile(latencies, 50), 2),
+            "p95_ms": round(1000 * percentile(latencies, 95), 2),
+            "p99_ms": round(1000 * percentile(latencies, 99), 2)
+        }
+
+    result = {route: stats(e["latencies"], e["errors"]) for route, e in sorted(routes.items())}
+    total = stats([s[1] for s in samples], sum(1 for s in samples if not s[2]))
+    return result, total
+
+
+def print_table(routes, total):
+    print(f"{'route':32} {'reqs':>7} {'err':>5} {'req/s':>9} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for route, s in list(routes.items()) + [('TOTAL', total)]:
+        print(f"{route:32} {s['requests']:>7} {s['errors']:>5} {s['rps']:>9.1f} "
+              f"{s['p50_ms']:>8.2f} {s['p95_ms']:>8.2f} {s['p99_ms']:>8.2f}")
+
+
+def print_comparison(current, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\nvs {previous['commit']} ({os.path.basename(previous_path)})")
+    print(f"{'route':32} {'req/s':>16} {'p95 ms':>18}")
+    rows = list(current['routes'].items()) + [('TOTAL', current['total'])]
+    for route, s in rows:
+        old = previous['total'] if route == 'TOTAL' else previous['routes'].get(route)
+        if not old:
+            continue
+
+        def delta(new, before):
+            return f"{(new - before) / before * 100:+.1f}%" if before else 'n/a'
+        print(f"{route:32} {s['rps']:>8.1f} {delta(s['rps'], old['rps']):>7} "
+              f"{s['p95_ms']:>9.2f} {delta(s['p95_ms'], old['p95_ms']):>8}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from benchmark.fake_auth0 import FakeAuth0
+    from benchmark.data import params_to_env
+    from benchmark.workloads import Context, MIXES, chooser
+    if args.mix not in MIXES:
+        sys.exit(f"unknown mix {args.mix!r}; choose from {', '.join(MIXES)}")
+
+    issuer = FakeAuth0(AUDIENCE).start()
+    env = {
+        "STORAGE_BACKEND": args.backend,
+        "AUTH0_DOMAIN": "benchmark.local",
+        "AUTH0_BASE_URL": issuer.base_url,
+        "AUTH0_CLIENT_ID": AUDIENCE,
+        "AUTH0_CLIENT_SECRET": "benchmark",
+        "JOB_BACKEND": "memory"
+    }
+    env.update(params_to_env(args.users, args.courses, args.students_per_course, args.seed))
+    if args.backend == 'sqlite':
+        env["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix='tarpaulin-bench-'), 'bench.db')
+
+    print(f"Generating {args.users} users / {args.courses} courses ({args.backend})...")
+    dataset = prepare_storage(args, env)
+    server, base_url = start_server(args, env)
+    try:
+        ctx = Context(dataset, issuer)
+        choose = chooser(args.mix)
+        if args.warmup > 0:
+            drive(base_url, ctx, choose, args.concurrency, args.warmup, args.seed + 1)
+        print(f"Running '{args.mix}' at concurrency {args.concurrency} for {args.duration}s...")
+        samples, elapsed = drive(base_url, ctx, choose, args.concurrency, args.duration, args.seed)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        issuer.stop()
+
+    routes, total = summarize(samples, elapsed)
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        "elapsed": round(elapsed, 3),
+        "routes": routes,
+        "total": total
+    }
+
+    print_table(routes, total)
+    os.makedirs(args.output, exist_ok=True)
+    name = f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{results['commit']}-{args.mix}.json"
+    path = os.path.join(args.output, name)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved {path}")
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
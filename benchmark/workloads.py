@@ -0,0 +1,120 @@
+# benchmark/workloads.py
+#
+# Request generators and the weighted mixes that combine them. Each
+# operation returns (route, method, path, headers, body); `route` is the
+# label latencies are reported under.
+from handlers.courses import encode_cursor
+from benchmark.data import user_sub, SUBJECTS, TERMS
+from benchmark.fake_auth0 import PASSWORD
+
+
+class Context:
+    def __init__(self, dataset, issuer):
+        self.dataset = dataset
+        self.issuer = issuer
+
+    def auth(self, user_id):
+        return {'Authorization': f'Bearer {self.issuer.token(user_sub(user_id))}'}
+
+    def admin(self):
+        return self.auth(self.dataset.admins[0])
+
+
+def list_courses(ctx, rng):
+    limit = rng.choice([3, 10, 25])
+    return 'GET /courses', 'GET', f'/courses?limit={limit}', {}, None
+
+
+def list_courses_cursor(ctx, rng):
+    # A later page, reached through a cursor
+    course_id, subject, _ = rng.choice(ctx.dataset.courses)
+    token = encode_cursor({"id": course_id, "subject": subject})
+    return 'GET /courses?cursor', 'GET', f'/courses?limit=10&cursor={token}', {}, None
+
+
+def search_courses(ctx, rng):
+    # Search-as-you-type: a subject plus a growing prefix of a number
+    subject = rng.choice(SUBJECTS).lower()
+    q = f"{subject}+{rng.randint(1, 9)}" if rng.random() < 0.5 else subject[:rng.randint(1, len(subject))]
+    return 'GET /courses?q', 'GET', f'/courses?q={q}&limit=10', {}, None
+
+
+def filter_courses(ctx, rng):
+    return 'GET /courses?term', 'GET', f'/courses?term={rng.choice(TERMS)}&limit=10', {}, None
+
+
+def get_course(ctx, rng):
+    course_id = rng.choice(ctx.dataset.courses)[0]
+    return 'GET /courses/:id', 'GET', f'/courses/{course_id}', {}, None
+
+
+def get_schedule(ctx, rng):
+    # A student's schedule: several courses in one batch read
+    course_ids = [c[0] for c in rng.sample(ctx.dataset.courses, min(6, len(ctx.dataset.courses)))]
+    return 'GET /courses?ids', 'GET', f"/courses?ids={','.join(map(str, course_ids))}", {}, None
+
+
+def batch_get_users(ctx, rng):
+    user_ids = rng.sample(ctx.dataset.students, min(10, len(ctx.dataset.students)))
+    return 'POST /users:batchGet', 'POST', '/users:batchGet', ctx.admin(), {"ids": user_ids}
+
+
+def get_user(ctx, rng):
+    user_id = rng.choice(ctx.dataset.students + ctx.dataset.instructors)
+    return 'GET /users/:id', 'GET', f'/users/{user_id}', ctx.auth(user_id), None
+
+
+def list_users(ctx, rng):
+    return 'GET /users', 'GET', '/users', ctx.admin(), None
+
+
+def get_enrollment(ctx, rng):
+    course_id, _, instructor_id = rng.choice(ctx.dataset.courses)
+    return 'GET /courses/:id/students', 'GET', f'/courses/{course_id}/students', \
+        ctx.auth(instructor_id), None
+
+
+def update_enrollment(ctx, rng):
+    course_id = rng.choice(ctx.dataset.courses)[0]
+    add, remove = rng.sample(ctx.dataset.students, 2)
+    return 'PATCH /courses/:id/students', 'PATCH', f'/courses/{course_id}/students', \
+        ctx.admin(), {"add": [add], "remove": [remove]}
+
+
+def update_course(ctx, rng):
+    course_id = rng.choice(ctx.dataset.courses)[0]
+    return 'PATCH /courses/:id', 'PATCH', f'/courses/{course_id}', \
+        ctx.admin(), {"title": f"Course {rng.randint(0, 10 ** 6)}"}
+
+
+def login(ctx, rng):
+    user_id = rng.choice(ctx.dataset.students)
+    return 'POST /users/login', 'POST', '/users/login', {}, \
+        {"username": user_sub(user_id), "password": PASSWORD}
+
+
+# Mix name -> [(weight, operation)]
+MIXES = {
+    'read': [
+        (35, list_courses), (10, list_courses_cursor), (35, get_course),
+        (10, get_user), (10, get_enrollment)
+    ],
+    'mixed': [
+        (25, list_courses), (5, list_courses_cursor), (25, get_course), (15, get_user),
+        (10, get_enrollment), (10, update_enrollment), (5, update_course),
+        (3, list_users), (2, login)
+    ],
+    'search': [(60, search_courses), (20, filter_courses), (20, get_course)],
+    'batch': [(50, get_schedule), (20, batch_get_users), (30, get_course)],
+    'write': [(50, update_enrollment), (30, update_course), (20, get_enrollment)],
+    'auth': [(50, login), (50, get_user)]
+}
+
+
+def chooser(mix):
+    operations = [op for _, op in MIXES[mix]]
+    weights = [weight for weight, _ in MIXES[mix]]
+
+    def choose(rng):
+        return rng.choices(operations, weights)[0]
+    return choose
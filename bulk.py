@@ -0,0 +1,201 @@
+# bulk.py
+#
+# Streaming bulk import and export of courses. Imports read the request
+# body a line at a time and write it in chunks; exports walk storage in
+# batches. Either way memory use doesn't grow with the data.
+import io
+import os
+import csv
+import json
+import zlib
+from repositories import COURSE_FIELDS, BATCH_SIZE
+
+# Rows validated and written together (one get_multi and one put_multi each)
+IMPORT_CHUNK_SIZE = min(int(os.getenv("IMPORT_CHUNK_SIZE", str(BATCH_SIZE))), BATCH_SIZE)
+# Longest accepted NDJSON line
+IMPORT_MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(64 * 1024)))
+
+# Content types accepted by POST /courses/import
+IMPORT_FORMATS = {
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv'
+}
+
+# Records read from storage per step of an export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", str(BATCH_SIZE)))
+
+# Formats offered by GET /courses/export
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+# Course fields holding numbers
+INTEGER_FIELDS = ('number', 'instructor_id')
+# Course fields holding text
+STRING_FIELDS = ('subject', 'title', 'term')
+
+
+# Check the types of whichever course fields are present; returns an error or None
+def field_type_error(fields):
+    for field in INTEGER_FIELDS:
+        if field in fields and (not isinstance(fields[field], int) or isinstance(fields[field], bool)):
+            return f"{field} must be an integer"
+    for field in STRING_FIELDS:
+        if field in fields and not isinstance(fields[field], str):
+            return f"{field} must be a string"
+    return None
+
+
+# Check one parsed row; returns (fields, None) or (None, error)
+def course_fields(data, from_csv=False):
+    if not isinstance(data, dict):
+        return None, "The row is invalid"
+    missing = [f for f in COURSE_FIELDS if data.get(f) in (None, '')]
+    if missing:
+        return None, f"Missing {', '.join(missing)}"
+
+    fields = {f: data[f] for f in COURSE_FIELDS}
+    if from_csv:
+        for field in INTEGER_FIELDS:
+            try:
+                fields[field] = int(fields[field])
+            except ValueError:
+                return None, f"{field} must be an integer"
+    error = field_type_error(fields)
+    if error:
+        return None, error
+    return fields, None
+
+
+# (line, fields, error) for each non-blank line of an NDJSON stream
+def ndjson_rows(stream):
+    line_number = 0
+    while True:
+        line = stream.readline(IMPORT_MAX_LINE_BYTES + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > IMPORT_MAX_LINE_BYTES and not line.endswith(b'\n'):
+            # Skip the rest of the oversized line without holding it
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(IMPORT_MAX_LINE_BYTES)
+            yield line_number, None, "The line is too long"
+            continue
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            yield line_number, None, "The line is not valid JSON"
+            continue
+        yield (line_number, *course_fields(data))
+
+
+# (line, fields, error) for each record of a CSV stream with a header row
+def csv_rows(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    try:
+        for data in reader:
+            yield (reader.line_num, *course_fields(data, from_csv=True))
+    except (csv.Error, UnicodeDecodeError) as e:
+        yield reader.line_num, None, f"The file could not be parsed: {e}"
+
+
+def read_rows(stream, fmt):
+    return csv_rows(stream) if fmt == 'csv' else ndjson_rows(stream)
+
+
+# Create the courses in `rows`, yielding one result per row in input
+# order. on_created is called with each written chunk of course records.
+def import_courses(repos, rows, on_created=None, chunk_size=IMPORT_CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield from _import_chunk(repos, chunk, on_created)
+            chunk = []
+    if chunk:
+        yield from _import_chunk(repos, chunk, on_created)
+
+
+def _import_chunk(repos, chunk, on_created):
+    # One lookup for every instructor the chunk names
+    instructor_ids = {fields['instructor_id'] for _, fields, _ in chunk if fields}
+    users = repos.users.get_multi(instructor_ids) if instructor_ids else {}
+
+    results = []
+    pending = []
+    for line, fields, error in chunk:
+        if error is None and users.get(fields['instructor_id'], {}).get('role') != 'instructor':
+            error = "instructor_id is not an instructor"
+        if error is not None:
+            results.append({"line": line, "status": 400, "Error": error})
+        else:
+            results.append({"line": line, "status": 201})
+            pending.append((results[-1], fields))
+
+    if pending:
+        created = repos.courses.create_multi([fields for _, fields in pending])
+        for (result, _), course in zip(pending, created):
+            result["id"] = course['id']
+        if on_created is not None:
+            on_created(created)
+    return results
+
+
+# Batches of (record type, record): courses with their rosters, then users
+def export_records(repos, include_users=False, batch_size=EXPORT_BATCH_SIZE):
+    for courses in repos.courses.scan(batch_size):
+        rosters = repos.enrollments.rosters(courses)
+        yield [('course', dict({f: c.get(f) for f in ['id'] + COURSE_FIELDS},
+                               students=list(rosters.get(c['id'], []))))
+               for c in courses]
+    if include_users:
+        for users in repos.users.scan(batch_size):
+            yield [('user', {"id": u['id'], "sub": u['sub'], "role": u['role']}) for u in users]
+
+
+def ndjson_chunks(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(dict(type=kind, **record)) + '\n' for kind, record in batch).encode()
+
+
+def csv_chunks(batches, include_users=False):
+    # One row per record; rosters are space-separated student ids. With
+    # users included, a `type` column tells the two kinds of row apart.
+    columns = ['id'] + COURSE_FIELDS + ['students']
+    if include_users:
+        columns = ['type'] + columns + ['sub', 'role']
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, columns, extrasaction='ignore')
+    writer.writeheader()
+    for batch in batches:
+        for kind, record in batch:
+            row = dict(record, type=kind)
+            if kind == 'course':
+                row['students'] = ' '.join(str(sid) for sid in record['students'])
+            writer.writerow(row)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def export_chunks(repos, fmt, include_users=False):
+    batches = export_records(repos, include_users)
+    if fmt == 'csv':
+        return csv_chunks(batches, include_users)
+    return ndjson_chunks(batches)
+
+
+def gzip_chunks(chunks):
+    # Compress a stream of byte chunks into one gzip member as it goes
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
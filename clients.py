@@ -0,0 +1,148 @@
+# clients.py
+import os
+import threading
+import requests
+import google.auth
+from requests.adapters import HTTPAdapter
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import datastore
+from metrics import InstrumentedDatastoreClient, response_hook, METRICS_ENABLED
+
+# Connection pool sizing for the HTTP sessions behind the clients
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+# "true"/"false" to force gRPC or HTTP for Datastore; unset keeps the library default
+DATASTORE_USE_GRPC = os.getenv("DATASTORE_USE_GRPC", "").lower()
+BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
+
+# Storage reads and writes, and signing URLs through IAM
+CREDENTIAL_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+
+def _tune_http(session):
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                          pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+class ClientRegistry:
+    # One Datastore client, one Storage client, their bucket handles, the
+    # GCS media session and the credentials the last three share, per
+    # worker process. Children forked after
+    # creation (gunicorn's pre-fork model) get a fresh registry instead of
+    # the parent's channels.
+    def __init__(self):
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._datastore = None
+        self._storage = None
+        self._media_session = None
+        self._credentials = None
+        self._project = None
+        self._buckets = {}
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def datastore(self):
+        self._check_pid()
+        if self._datastore is None:
+            with self._lock:
+                if self._datastore is None:
+                    kwargs = {}
+                    if DATASTORE_USE_GRPC in ('true', 'false'):
+                        kwargs['_use_grpc'] = DATASTORE_USE_GRPC == 'true'
+                    client = datastore.Client(**kwargs)
+                    if METRICS_ENABLED:
+                        client = InstrumentedDatastoreClient(client)
+                    self._datastore = client
+        return self._datastore
+
+    def credentials(self):
+        # Application default credentials, loaded once; the emulator takes none
+        self._check_pid()
+        if self._credentials is None and not os.getenv("STORAGE_EMULATOR_HOST"):
+            with self._lock:
+                if self._credentials is None:
+                    self._credentials, self._project = google.auth.default(scopes=CREDENTIAL_SCOPES)
+        return self._credentials
+
+    def storage(self):
+        self._check_pid()
+        if self._storage is None:
+            credentials = self.credentials()
+            with self._lock:
+                if self._storage is None:
+                    from google.cloud import storage
+                    if credentials is None:
+                        self._storage = storage.Client()
+                    else:
+                        self._storage = storage.Client(project=self._project, credentials=credentials)
+        return self._storage
+
+    def media_session(self):
+        # Pooled session for streaming avatar media from the GCS JSON API,
+        # built on google-auth's public transport rather than the Storage
+        # client's internal one.
+        self._check_pid()
+        if self._media_session is None:
+            credentials = self.credentials()
+            with self._lock:
+                if self._media_session is None:
+                    if credentials is None:
+                        session = requests.Session()
+                    else:
+                        session = AuthorizedSession(credentials)
+                    _tune_http(session)
+                    if METRICS_ENABLED:
+                        session.hooks['response'].append(response_hook('gcs'))
+                    self._media_session = session
+        return self._media_session
+
+    def bucket(self, name):
+        self._check_pid()
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            bucket = self.storage().bucket(name)
+            self._buckets[name] = bucket
+        return bucket
+
+    def warm_up(self):
+        self.datastore()
+        if BUCKET_NAME:
+            self.bucket(BUCKET_NAME)
+            self.media_session()
+
+
+registry = ClientRegistry()
+
+
+def get_datastore_client():
+    return registry.datastore()
+
+
+def get_storage_client():
+    return registry.storage()
+
+
+def get_media_session():
+    return registry.media_session()
+
+
+def get_credentials():
+    return registry.credentials()
+
+
+def get_bucket(name=BUCKET_NAME):
+    return registry.bucket(name)
+
+
+def warm_up():
+    registry.warm_up()
@@ -0,0 +1,50 @@
+# concurrency.py
+import os
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads per worker process for running a request's independent I/O calls
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "16"))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # Shared pool, rebuilt after a fork
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS,
+                                           thread_name_prefix='fanout')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def submit(fn, *args, **kwargs):
+    # Run fn in the pool with the caller's context variables (so its calls
+    # are still charged to the request). fn must not touch flask.g or
+    # flask.request; pass it what it needs instead.
+    if FANOUT_WORKERS <= 0:
+        return _Done(fn, *args, **kwargs)
+    context = contextvars.copy_context()
+    return get_executor().submit(context.run, fn, *args, **kwargs)
+
+
+class _Done:
+    # Future-like result of running inline when fan-out is disabled
+    def __init__(self, fn, *args, **kwargs):
+        try:
+            self._result, self._error = fn(*args, **kwargs), None
+        except Exception as e:
+            self._result, self._error = None, e
+
+    def result(self, timeout=None):
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def cancel(self):
+        return False
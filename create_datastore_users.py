@@ -1,8 +1,8 @@
 import os
-import requests
 from google.cloud import datastore
 from dotenv import load_dotenv
 from jose import jwt
+from auth0 import request_token
 
 # Load environment variables from .env file
 load_dotenv()
@@ -27,24 +27,15 @@ users_to_create = [
 
 # Request an ID token from Auth0 for a given user's credentials
 def get_id_token(email):
-    url = f"https://{AUTH0_DOMAIN}/oauth/token"
-    payload = {
-        "grant_type": "password",
-        "username": email,
-        "password": PASSWORD,
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "scope": "openid profile email"
-    }
-    headers = { 'content-type': 'application/json' }
-    resp = requests.post(url, json=payload, headers=headers)
+    status, body = request_token(email, PASSWORD, domain=AUTH0_DOMAIN,
+                                 client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
 
     try:
-        return resp.json()['id_token']
+        return body['id_token']
     except KeyError:
         print(f"Failed to get id_token for {email}")
-        print("Status Code:", resp.status_code)
-        print("Response JSON:", resp.json())
+        print("Status Code:", status)
+        print("Response JSON:", body)
         raise
 
 # Extract the sub claim from the ID token
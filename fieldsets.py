@@ -0,0 +1,41 @@
+# fieldsets.py
+#
+# Sparse fieldsets: ?fields=id,title limits a response to the named
+# fields, and tells storage which properties it actually has to read.
+# Also the id lists of the batch reads (GET /courses?ids=, POST /users:batchGet).
+import os
+
+# Most ids one batch read may ask for (Datastore allows 1000 keys per lookup)
+BATCH_GET_MAX = min(int(os.getenv("BATCH_GET_MAX", "100")), 1000)
+
+# Fields each kind of response can return
+USER_FIELDS = ['id', 'sub', 'role', 'avatar_url', 'courses']
+USER_LIST_FIELDS = ['id', 'sub', 'role']
+COURSE_RESPONSE_FIELDS = ['id', 'subject', 'number', 'title', 'term', 'instructor_id', 'self']
+
+
+def parse_fields(args, allowed):
+    # Requested fields in response order, or None for all of them.
+    # Raises ValueError on a field the response doesn't have.
+    if 'fields' not in args:
+        return None
+    requested = {f.strip() for f in args.get('fields', '').split(',') if f.strip()}
+    if not requested or not requested.issubset(allowed):
+        raise ValueError("invalid fields")
+    return [f for f in allowed if f in requested]
+
+
+def select_fields(obj, fields):
+    if fields is None:
+        return obj
+    return {k: v for k, v in obj.items() if k in fields}
+
+
+def parse_ids(ids):
+    # Validated list of ids for a batch read, in request order (duplicates
+    # kept). Raises ValueError if it isn't 1..BATCH_GET_MAX integers.
+    if not isinstance(ids, list) or not 0 < len(ids) <= BATCH_GET_MAX:
+        raise ValueError("invalid ids")
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        raise ValueError("invalid ids")
+    return ids
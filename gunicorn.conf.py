@@ -0,0 +1,39 @@
+# gunicorn.conf.py
+# Picked up automatically when gunicorn is started from the project root.
+import os
+
+# Threaded workers: each process serves GUNICORN_THREADS requests at once
+# over one shared set of clients, so a request waiting on Datastore/GCS no
+# longer holds a whole process. Worker count comes from -w/WEB_CONCURRENCY.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+
+def post_worker_init(worker):
+    # Build the storage backend (and, for Datastore, the shared clients)
+    # before the worker accepts its first request
+    from repositories import get_repositories, STORAGE_BACKEND
+    get_repositories()
+    if STORAGE_BACKEND == 'datastore':
+        from clients import warm_up
+        warm_up()
+
+    # Build the course search index from storage; if that fails the first
+    # search builds it instead
+    from search import course_index
+    try:
+        course_index.load()
+    except Exception:
+        worker.log.exception("Building the course search index failed")
+
+    # Start the background job worker and resume unfinished jobs
+    from jobs import job_queue
+    job_queue.start()
+
+
+def child_exit(server, worker):
+    # Drop a dead worker's live gauges from the shared Prometheus files
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
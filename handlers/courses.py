@@ -1,9 +1,31 @@
-from flask import Blueprint, request, jsonify
-from google.cloud import datastore
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from utils import verify_jwt
+from principals import get_principal
+from repositories import get_repositories, CourseDeleted, BATCH_SIZE, sort_field, sort_value
+from jobs import job_queue
+from concurrency import submit
+from response_cache import response_cache
+from bulk import (IMPORT_FORMATS, EXPORT_FORMATS, read_rows, import_courses, export_chunks, gzip_chunks,
+                  field_type_error)
+from search import course_index
+from fieldsets import parse_fields, select_fields, parse_ids, COURSE_RESPONSE_FIELDS
+from urllib.parse import urlencode
 import os
+import json
+import bisect
+import base64
+import logging
 
 courses_bp = Blueprint('courses', __name__)
+logger = logging.getLogger(__name__)
+
+# Users cleaned up per step of a course deletion
+ENROLLMENT_BATCH_SIZE = BATCH_SIZE
+# Most courses, and most distinct students, one roster PATCH may name
+# (each set is validated with one lookup, which Datastore caps at 1000 keys)
+ENROLLMENT_MAX_IDS = min(int(os.getenv("ENROLLMENT_MAX_IDS", "1000")), 1000)
+# Largest page GET /courses serves; bigger limits are cut down to it
+COURSE_PAGE_MAX = int(os.getenv("COURSE_PAGE_MAX", "100"))
 
 
 ## Functionality: Create a course
@@ -16,113 +38,299 @@ def create_course():
     if payload is None:
         return jsonify({"Error": "Unauthorized"}), 401
 
-    client = datastore.Client()
-    sub = payload['sub']
-    requester = next(
-        (u for u in client.query(kind='users').fetch() if u['sub'] == sub),
-        None
-    )
+    requester = get_principal(payload)
 
-    if requester is None or requester['role'] != 'admin':
+    if requester is None or requester.role != 'admin':
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     data = request.get_json()
     required_fields = ['subject', 'number', 'title', 'term', 'instructor_id']
     if not data or not all(f in data for f in required_fields):
         return jsonify({"Error": "The request body is invalid"}), 400
+    # Listings sort and filter on these, so mixed types can't be stored
+    if field_type_error(data):
+        return jsonify({"Error": "The request body is invalid"}), 400
 
     # Check instructor_id is valid and corresponds to an instructor
-    key = client.key('users', data['instructor_id'])
-    instructor = client.get(key)
+    repos = get_repositories()
+    instructor = repos.users.get(data['instructor_id'])
     if not instructor or instructor.get('role') != 'instructor':
         return jsonify({"Error": "The request body is invalid"}), 400
 
-    new_course = datastore.Entity(key=client.key('courses'))
-    new_course.update({
-        "subject": data['subject'],
-        "number": data['number'],
-        "title": data['title'],
-        "term": data['term'],
-        "instructor_id": data['instructor_id'],
-        "students": []
-    })
+    new_course = repos.courses.create(data)
+    response_cache.invalidate('courses')
+    course_index.add(new_course)
 
-    client.put(new_course)  # index all fields by default
-
-    course_id = new_course.key.id
+    course_id = new_course['id']
     result = dict(data)
     result['id'] = course_id
     result['self'] = f"{request.host_url.rstrip('/')}/courses/{course_id}"
     return jsonify(result), 201
 
 
+## Functionality: Import courses
+## Endpoint: POST /courses/import
+## Protection: Admin only
+## Description: Create many courses from an NDJSON (application/x-ndjson)
+## or CSV (text/csv, with a header row) body. The body is read as it
+## arrives and written in batches. Answers with an NDJSON stream holding
+## one result per row, then a summary line.
+@courses_bp.route('/courses/import', methods=['POST'])
+def import_courses_route():
+    payload = verify_jwt(request)
+    if payload is None:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    requester = get_principal(payload)
+    if requester is None or requester.role != 'admin':
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    fmt = IMPORT_FORMATS.get(request.mimetype)
+    if fmt is None:
+        return jsonify({"Error": "The request body must be NDJSON or CSV"}), 415
+
+    repos = get_repositories()
+    host = request.host_url.rstrip('/')
+
+    def invalidate(created):
+        response_cache.invalidate('courses')
+        for course in created:
+            course_index.add(course)
+
+    def generate():
+        created = failed = 0
+        try:
+            for result in import_courses(repos, read_rows(request.stream, fmt), invalidate):
+                if result["status"] == 201:
+                    created += 1
+                    result["self"] = f"{host}/courses/{result['id']}"
+                else:
+                    failed += 1
+                yield json.dumps(result) + '\n'
+        except Exception:
+            # Rows reported so far are stored; the rest were not imported
+            logger.exception("Course import stopped")
+            yield json.dumps({"Error": "The import stopped early", "created": created, "failed": failed}) + '\n'
+            return
+        yield json.dumps({"created": created, "failed": failed}) + '\n'
+
+    return Response(stream_with_context(generate()), status=200, mimetype='application/x-ndjson')
+
+
+## Functionality: Export courses
+## Endpoint: GET /courses/export
+## Protection: Admin only
+## Description: Streams every course with its students list as NDJSON
+## (default) or CSV (?format=csv). ?include=users appends the users.
+## Gzipped on the fly when the client accepts it.
+@courses_bp.route('/courses/export', methods=['GET'])
+def export_courses_route():
+    payload = verify_jwt(request)
+    if payload is None:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    requester = get_principal(payload)
+    if requester is None or requester.role != 'admin':
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"Error": "The format is invalid"}), 400
+    include_users = 'users' in request.args.get('include', '').split(',')
+
+    body = export_chunks(get_repositories(), fmt, include_users)
+    headers = {"Content-Disposition": f'attachment; filename="courses.{fmt}"'}
+    if request.accept_encodings['gzip']:
+        body = gzip_chunks(body)
+        headers["Content-Encoding"] = 'gzip'
+
+    resp = Response(body, status=200, mimetype=EXPORT_FORMATS[fmt], headers=headers)
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+# Encode the sort value and id of the last course on a page as an opaque token
+def encode_cursor(course, field='subject'):
+    raw = json.dumps([course[field], course['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, field='subject'):
+    padded = token + '=' * (-len(token) % 4)
+    value, course_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    if not isinstance(course_id, int) or not isinstance(value, int if field == 'number' else str):
+        raise ValueError("invalid cursor")
+    return value, course_id
+
+
+# Listing filters from the query string
+def parse_filters(args):
+    filters = {}
+    for name in ('subject', 'term'):
+        if args.get(name):
+            filters[name] = args[name]
+    for name in ('instructor_id', 'number_min', 'number_max'):
+        if name in args:
+            value = args.get(name, type=int)
+            if value is None:
+                raise ValueError(f"invalid {name}")
+            filters[name] = value
+    return filters
+
+
+# A page of search results, with the same paging rules as list_page
+def page_of(docs, limit, field, cursor=None, offset=None):
+    if offset is not None:
+        start = offset
+    elif cursor is not None:
+        start = bisect.bisect_right([(sort_value(d[field]), d['id']) for d in docs],
+                                    (sort_value(cursor[0]), cursor[1]))
+    else:
+        start = 0
+    return docs[start:start + limit]
+
+
 ## Functionality: Get all courses
 ## Endpoint: GET /courses
 ## Protection: Unprotected
-## Description: Paginated using offset/limit. Page size is 3. 
-## Ordered by "subject."  Doesn’t return info on course enrollment.
+## Description: Paginated using an opaque cursor (or the older
+## offset/limit links). Page size is 3. Ordered by "subject."
+## Doesn’t return info on course enrollment. Optional filters
+## (subject, term, instructor_id, number_min/number_max) and a q=
+## search; ?facets=1 adds counts per term and subject of all the
+## matching courses. ?fields=
+## limits the course fields returned. ?ids=1,2,3 instead returns those
+## courses in the order given (see get_courses_by_id).
 @courses_bp.route('/courses', methods=['GET'])
+@response_cache.cached('courses')
 def get_all_courses():
-    client = datastore.Client()
-    query = client.query(kind='courses')
+    repos = get_repositories()
+    host = request.host_url.rstrip('/')
 
-    # Fetch and sort all courses by subject
-    all_courses = list(query.fetch())
-    all_courses.sort(key=lambda c: c['subject'])
+    if 'ids' in request.args:
+        return get_courses_by_id(repos, host)
 
     # Use default limit=3 for pagination
-    offset = request.args.get('offset', default=0, type=int)
-    limit = request.args.get('limit', default=3, type=int)
+    limit = min(max(request.args.get('limit', default=3, type=int), 1), COURSE_PAGE_MAX)
 
-    # Paginate the sorted list
-    paged_courses = all_courses[offset:offset + limit]
+    try:
+        filters = parse_filters(request.args)
+    except ValueError:
+        return jsonify({"Error": "The filter is invalid"}), 400
+    q = request.args.get('q', '').strip()
+    field = sort_field(filters)
 
-    courses = []
-    for course in paged_courses:
-        courses.append({
-            "id": course.key.id,
-            "subject": course['subject'],
-            "number": course['number'],
-            "title": course['title'],
-            "term": course['term'],
-            "instructor_id": course['instructor_id'],
-            "self": f"{request.host_url.rstrip('/')}/courses/{course.key.id}"
-        })
+    try:
+        fields = parse_fields(request.args, COURSE_RESPONSE_FIELDS)
+    except ValueError:
+        return jsonify({"Error": "The fields are invalid"}), 400
+    # Course properties storage has to read ("self" is built from the id)
+    record_fields = [f for f in fields if f != 'self'] if fields is not None else None
+
+    offset = cursor = None
+    if 'offset' in request.args:
+        offset = max(request.args.get('offset', default=0, type=int), 0)
+    elif request.args.get('cursor'):
+        try:
+            cursor = decode_cursor(request.args['cursor'], field)
+        except Exception:
+            return jsonify({"Error": "The cursor is invalid"}), 400
+
+    # Read one extra course to learn whether another page exists. Searches
+    # are answered from the in-process index; plain filters go to storage.
+    if q:
+        matches = course_index.search(q, filters)
+        fetched = page_of(matches, limit + 1, field, cursor, offset)
+    else:
+        fetched = repos.courses.list_page(limit + 1, cursor=cursor, offset=offset, filters=filters,
+                                          fields=record_fields)
+    # Facets are counted by the index, and only when asked for
+    facets = None
+    if request.args.get('facets', '').lower() in ('1', 'true'):
+        facets = course_index.facets(q, filters)
+
+    # Courses waiting on their deletion cleanup are hidden
+    has_more = len(fetched) > limit
+    paged_courses = [c for c in fetched[:limit] if not c.get('deleted')]
+
+    courses = [select_fields(course_json(course, host), fields) for course in paged_courses]
 
     result = {"courses": courses}
-
-    # Add correct next link if more courses remain
-    if (offset + limit) < len(all_courses):
-        result["next"] = f"{request.host_url.rstrip('/')}/courses?limit={limit}&offset={offset + limit}"
+    if facets is not None:
+        result["facets"] = facets
+
+    # Add correct next link if more courses remain, keeping the filters
+    if has_more:
+        query = urlencode([(k, v) for k, v in request.args.items(multi=True)
+                           if k not in ('limit', 'offset', 'cursor')])
+        query = f"&{query}" if query else ""
+        if offset is not None:
+            result["next"] = f"{host}/courses?limit={limit}&offset={offset + limit}{query}"
+        else:
+            token = encode_cursor(fetched[limit - 1], field)
+            result["next"] = f"{host}/courses?limit={limit}&cursor={token}{query}"
 
     return jsonify(result), 200
 
 
+# Response body for a course record; fields the record lacks come out as None
+def course_json(course, host):
+    return {
+        "id": course['id'],
+        "subject": course.get('subject'),
+        "number": course.get('number'),
+        "title": course.get('title'),
+        "term": course.get('term'),
+        "instructor_id": course.get('instructor_id'),
+        "self": f"{host}/courses/{course['id']}"
+    }
+
+
+# GET /courses?ids=1,2,3: the courses in request order, read with one
+# get_multi. Missing (or deleted) courses get {"id", "Error"} in their place.
+def get_courses_by_id(repos, host):
+    try:
+        ids = parse_ids([int(i) for i in request.args['ids'].split(',')])
+    except ValueError:
+        return jsonify({"Error": "The ids are invalid"}), 400
+    try:
+        fields = parse_fields(request.args, COURSE_RESPONSE_FIELDS)
+    except ValueError:
+        return jsonify({"Error": "The fields are invalid"}), 400
+
+    found = repos.courses.get_multi(ids)
+    courses = []
+    for course_id in ids:
+        course = found.get(course_id)
+        if not course or course.get('deleted'):
+            courses.append({"id": course_id, "Error": "Not found"})
+        else:
+            courses.append(select_fields(course_json(course, host), fields))
+    return jsonify({"courses": courses}), 200
+
+
 ## Functionality: Get a course
 ## Endpoint: GET /courses/:id
 ## Protection: Unprotected
-## Description: Doesn’t return info on course enrollment.
+## Description: Doesn’t return info on course enrollment. ?fields=
+## limits the fields returned.
 @courses_bp.route('/courses/<int:course_id>', methods=['GET'])
+@response_cache.cached('course:{course_id}')
 def get_course(course_id):
-    client = datastore.Client()
-    key = client.key('courses', course_id)
-    course = client.get(key)
-    
-    # Return 404 if course doesn't exist
-    if not course:
+    try:
+        fields = parse_fields(request.args, COURSE_RESPONSE_FIELDS)
+    except ValueError:
+        return jsonify({"Error": "The fields are invalid"}), 400
+
+    course = get_repositories().courses.get(course_id)
+
+    # Return 404 if course doesn't exist (or is being deleted)
+    if not course or course.get('deleted'):
         return jsonify({"Error": "Not found"}), 404
 
     # Build and return the course object
-    result = {
-        "id": course_id,
-        "subject": course['subject'],
-        "number": course['number'],
-        "title": course['title'],
-        "term": course['term'],
-        "instructor_id": course['instructor_id'],
-        "self": f"{request.host_url.rstrip('/')}/courses/{course_id}"
-    }
-    return jsonify(result), 200
+    result = course_json(course, request.host_url.rstrip('/'))
+    return jsonify(select_fields(result, fields)), 200
 
 
 ## Functionality: Update a course
@@ -131,24 +339,22 @@ def get_course(course_id):
 ## Description: Partial update.
 @courses_bp.route('/courses/<int:course_id>', methods=['PATCH'])
 def update_course(course_id):
-    client = datastore.Client()
+    repos = get_repositories()
 
     # Authentication
     payload = verify_jwt(request)
     if payload is None:
         return jsonify({"Error": "Unauthorized"}), 401
 
-    sub = payload['sub']
-    admin = next((u for u in client.query(kind='users').fetch() if u.get('sub') == sub), None)
+    admin = get_principal(payload)
 
     # Authorize
-    if not admin or admin.get('role') != 'admin':
+    if not admin or admin.role != 'admin':
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     # Fetch the course
-    course_key = client.key('courses', course_id)
-    course = client.get(course_key)
-    if not course:
+    course = repos.courses.get(course_id)
+    if not course or course.get('deleted'):
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     # Validate and handle body
@@ -156,45 +362,42 @@ def update_course(course_id):
         content = request.get_json()
     except:
         return jsonify({"Error": "The request body is invalid"}), 400
-    if not isinstance(content, dict):
+    if not isinstance(content, dict) or field_type_error(content):
         return jsonify({"Error": "The request body is invalid"}), 400
 
     # Return course unchanged
     if content == {}:
         updated = {
-            "id": course.key.id,
+            "id": course['id'],
             "subject": course["subject"],
             "number": course["number"],
             "title": course["title"],
             "term": course["term"],
             "instructor_id": course["instructor_id"],
-            "self": f"{request.host_url}courses/{course.key.id}".rstrip('/')
+            "self": f"{request.host_url}courses/{course['id']}".rstrip('/')
         }
         return jsonify(updated), 200
 
     # Validate instructor
     if 'instructor_id' in content:
-        instructor_key = client.key('users', content['instructor_id'])
-        instructor = client.get(instructor_key)
+        instructor = repos.users.get(content['instructor_id'])
         if not instructor or instructor.get('role') != 'instructor':
             return jsonify({"Error": "The request body is invalid"}), 400
 
     # Apply updates
-    for field in ['subject', 'number', 'title', 'term', 'instructor_id']:
-        if field in content:
-            course[field] = content[field]
-
-    client.put(course)
+    course = repos.courses.update(course_id, content)
+    response_cache.invalidate('courses', f'course:{course_id}')
+    course_index.add(course)
 
     # Return updated course
     updated = {
-        "id": course.key.id,
+        "id": course['id'],
         "subject": course["subject"],
         "number": course["number"],
         "title": course["title"],
         "term": course["term"],
         "instructor_id": course["instructor_id"],
-        "self": f"{request.host_url}courses/{course.key.id}".rstrip('/')
+        "self": f"{request.host_url}courses/{course['id']}".rstrip('/')
     }
 
     return jsonify(updated), 200
@@ -205,48 +408,131 @@ def update_course(course_id):
 ## Endpoint: DELETE /courses/:id
 ## Protection: Admin only
 ## Description: Delete course and delete enrollment info about the course.
+## The course is tombstoned immediately; enrollment cleanup runs in the
+## background (see GET /courses/:id/deletion).
 @courses_bp.route('/courses/<int:course_id>', methods=['DELETE'])
 def delete_course(course_id):
-    client = datastore.Client()
+    repos = get_repositories()
 
     # Authentication
     payload = verify_jwt(request)
     if payload is None:
         return jsonify({"Error": "Unauthorized"}), 401
 
-    sub = payload['sub']
-    user = next((u for u in client.query(kind='users').fetch() if u.get('sub') == sub), None)
+    user = get_principal(payload)
 
     # Authorization
-    if not user or user.get('role') != 'admin':
+    if not user or user.role != 'admin':
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     # Fetch course
-    course_key = client.key('courses', course_id)
-    course = client.get(course_key)
+    course = repos.courses.get(course_id)
     if not course:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    # Remove course from instructor
-    instructor_id = course.get('instructor_id')
-    if instructor_id:
-        instructor_key = client.key('users', instructor_id)
-        instructor = client.get(instructor_key)
-        if instructor and 'courses' in instructor:
-            instructor['courses'] = [c for c in instructor['courses'] if c != course_id]
-            client.put(instructor)
-
-    # Remove course from students
-    for student_id in course.get('students', []):
-        student_key = client.key('users', student_id)
-        student = client.get(student_key)
-        if student and 'courses' in student:
-            student['courses'] = [c for c in student['courses'] if c != course_id]
-            client.put(student)
+    # Already tombstoned: make sure its cleanup job is still alive
+    if course.get('deleted'):
+        job = job_queue.get(deletion_job_id(course_id))
+        if job is None or job['status'] == 'failed':
+            enqueue_course_deletion(course_id, course)
+        elif job['status'] != 'done':
+            # Runs again (from its last reported batch) if its worker died
+            # and the lease ran out; a live job is left alone
+            job_queue.resume(job['id'])
+        return '', 204
+
+    # Tombstone the course so it disappears from reads right away. The
+    # enrollment links are moved aside for the background cleanup.
+    course = repos.courses.tombstone(course_id)
+    response_cache.invalidate('courses', f'course:{course_id}')
+    course_index.remove(course_id)
+
+    enqueue_course_deletion(course_id, course)
+    return '', 204
+
+
+def deletion_job_id(course_id):
+    return f"delete-course-{course_id}"
+
+
+def enqueue_course_deletion(course_id, course):
+    total = len(course.get('removed_students', [])) + (1 if course.get('removed_instructor_id') else 0)
+    job_queue.enqueue('delete_course', deletion_job_id(course_id),
+                      {"course_id": course_id}, total=total)
+
+
+# Background half of DELETE /courses/:id. Removes the course from its
+# instructor and students in batches, then from anyone still enrolled
+# (roster writes that landed after the snapshot), then deletes the
+# tombstone. Safe to run again after a crash: it resumes from the last
+# reported batch.
+def cascade_course_deletion(job):
+    repos = get_repositories()
+    course_id = job['params']['course_id']
+    course = repos.courses.get(course_id)
+    if not course or not course.get('deleted'):
+        return
+
+    user_ids = list(course.get('removed_students', []))
+    if course.get('removed_instructor_id'):
+        user_ids.insert(0, course['removed_instructor_id'])
+
+    for start in range(job.get('processed', 0), len(user_ids), ENROLLMENT_BATCH_SIZE):
+        chunk = user_ids[start:start + ENROLLMENT_BATCH_SIZE]
+        repos.enrollments.unlink_course(course_id, chunk)
+        job.report(start + len(chunk), total=len(user_ids))
+
+    # The tombstone stops new roster writes, so one query finds the rest
+    leftover = repos.enrollments.students_of(course_id)
+    for start in range(0, len(leftover), ENROLLMENT_BATCH_SIZE):
+        chunk = leftover[start:start + ENROLLMENT_BATCH_SIZE]
+        repos.enrollments.unlink_course(course_id, chunk)
+        job.report(len(user_ids) + start + len(chunk), total=len(user_ids) + len(leftover))
 
     # Delete the course
-    client.delete(course_key)
-    return '', 204
+    repos.courses.delete(course_id)
+
+
+job_queue.register('delete_course', cascade_course_deletion)
+
+
+## Functionality: Get deletion status of a course
+## Endpoint: GET /courses/:id/deletion
+## Protection: Admin only
+## Description: Progress of the background cleanup started by
+## DELETE /courses/:id.
+@courses_bp.route('/courses/<int:course_id>/deletion', methods=['GET'])
+def get_course_deletion(course_id):
+    # Authentication
+    payload = verify_jwt(request)
+    if payload is None:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    # Authorization
+    user = get_principal(payload)
+    if not user or user.role != 'admin':
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    job = job_queue.get(deletion_job_id(course_id))
+    if not job:
+        return jsonify({"Error": "Not found"}), 404
+
+    result = {
+        "id": course_id,
+        "status": job['status'],
+        "processed": job.get('processed', 0),
+        "total": job.get('total', 0),
+        "attempts": job.get('attempts', 0)
+    }
+    if job.get('error'):
+        result["error"] = job['error']
+    return jsonify(result), 200
+
+
+# Whether every roster id is a plain integer (JSON true/false would pass
+# isinstance(..., int), and lists or objects can't go into a set)
+def all_ints(ids):
+    return all(type(i) is int for i in ids)
 
 
 ## Functionality: Update enrollment in a course
@@ -255,25 +541,23 @@ def delete_course(course_id):
 ## Description: Enroll or disenroll students from the course.
 @courses_bp.route('/courses/<int:course_id>/students', methods=['PATCH'])
 def update_course_enrollment(course_id):
-    client = datastore.Client()
+    repos = get_repositories()
 
     # Authentication
     payload = verify_jwt(request)
     if payload is None:
         return jsonify({"Error": "Unauthorized"}), 401
 
-    sub = payload['sub']
-    user = next((u for u in client.query(kind='users').fetch() if u.get('sub') == sub), None)
-
-    # Fetch course
-    course_key = client.key('courses', course_id)
-    course = client.get(course_key)
-    if not course or user is None:
+    # Fetch course while the requester is resolved
+    course_future = submit(repos.courses.get, course_id)
+    user = get_principal(payload)
+    course = course_future.result()
+    if not course or course.get('deleted') or user is None:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     # Authorization
-    is_admin = user.get('role') == 'admin'
-    is_instructor = user.key.id == course.get('instructor_id')
+    is_admin = user.role == 'admin'
+    is_instructor = user.id == course.get('instructor_id')
     if not (is_admin or is_instructor):
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
@@ -287,78 +571,128 @@ def update_course_enrollment(course_id):
 
     if not isinstance(add_ids, list) or not isinstance(remove_ids, list):
         return jsonify({"Error": "Enrollment data is invalid"}), 409
+    if not all_ints(add_ids + remove_ids):
+        return jsonify({"Error": "The request body is invalid"}), 400
     if len(add_ids) == 0 and len(remove_ids) == 0:
         return jsonify({"Error": "Enrollment data is invalid"}), 409
     if set(add_ids).intersection(remove_ids):
         return jsonify({"Error": "Enrollment data is invalid"}), 409
 
     # Validate that all IDs are existing students
-    user_keys = [client.key('users', sid) for sid in set(add_ids + remove_ids)]
-    user_entities = client.get_multi(user_keys)
-
-    fetched_ids = {e.key.id for e in user_entities if e}
-    valid_students = {e.key.id for e in user_entities if e and e.get('role') == 'student'}
     all_ids = set(add_ids + remove_ids)
+    if len(all_ids) > ENROLLMENT_MAX_IDS:
+        return jsonify({"Error": f"At most {ENROLLMENT_MAX_IDS} students can be changed per request"}), 413
+    students = repos.users.get_multi(all_ids)
+    valid_students = {uid for uid, u in students.items() if u.get('role') == 'student'}
 
-    if not all_ids.issubset(fetched_ids) or not all_ids.issubset(valid_students):
+    if not all_ids.issubset(valid_students):
         return jsonify({"Error": "Enrollment data is invalid"}), 409
 
-    # Update course student list
-    current_students = set(course.get('students', []))
-    updated_students = current_students.union(add_ids).difference(remove_ids)
-    course['students'] = list(updated_students)
-    client.put(course)
-
-    # Update student enrollment references
-    for sid in add_ids:
-        student_key = client.key('users', sid)
-        student = client.get(student_key)
-        if student:
-            enrolled = set(student.get('courses', []))
-            enrolled.add(course_id)
-            student['courses'] = list(enrolled)
-            client.put(student)
-
-    for sid in remove_ids:
-        student_key = client.key('users', sid)
-        student = client.get(student_key)
-        if student:
-            enrolled = set(student.get('courses', []))
-            enrolled.discard(course_id)
-            student['courses'] = list(enrolled)
-            client.put(student)
+    # The records fetched for validation are written back as they are.
+    # A course deleted since it was fetched refuses the change.
+    try:
+        repos.enrollments.apply({course_id: (add_ids, remove_ids)}, {course_id: course}, students)
+    except CourseDeleted:
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     return '', 200
 
 
+## Functionality: Update enrollment in many courses
+## Endpoint: PATCH /courses/students
+## Protection: Admin only
+## Description: Enroll or disenroll students across several courses in
+## one call. Body: {"courses": [{"id": 1, "add": [...], "remove": [...]}]}
+@courses_bp.route('/courses/students', methods=['PATCH'])
+def bulk_update_enrollment():
+    repos = get_repositories()
+
+    # Authentication
+    payload = verify_jwt(request)
+    if payload is None:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    # Authorization
+    user = get_principal(payload)
+    if not user or user.role != 'admin':
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    # Validate body
+    content = request.get_json(silent=True)
+    if not isinstance(content, dict) or not isinstance(content.get('courses'), list):
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    changes = {}
+    for item in content['courses']:
+        if not isinstance(item, dict) or type(item.get('id')) is not int:
+            return jsonify({"Error": "The request body is invalid"}), 400
+        add_ids = item.get('add', [])
+        remove_ids = item.get('remove', [])
+        if not isinstance(add_ids, list) or not isinstance(remove_ids, list):
+            return jsonify({"Error": "Enrollment data is invalid"}), 409
+        if not all_ints(add_ids + remove_ids):
+            return jsonify({"Error": "The request body is invalid"}), 400
+        if item['id'] in changes or set(add_ids).intersection(remove_ids):
+            return jsonify({"Error": "Enrollment data is invalid"}), 409
+        changes[item['id']] = (add_ids, remove_ids)
+
+    if not changes:
+        return jsonify({"Error": "Enrollment data is invalid"}), 409
+    if len(changes) > ENROLLMENT_MAX_IDS:
+        return jsonify({"Error": f"At most {ENROLLMENT_MAX_IDS} courses can be changed per request"}), 413
+
+    # Fetch every course in one call
+    courses = {cid: c for cid, c in repos.courses.get_multi(changes).items() if not c.get('deleted')}
+    if set(changes) - set(courses):
+        return jsonify({"Error": "Enrollment data is invalid"}), 409
+
+    # Validate that all IDs are existing students
+    all_ids = set()
+    for add_ids, remove_ids in changes.values():
+        all_ids.update(add_ids, remove_ids)
+    if len(all_ids) > ENROLLMENT_MAX_IDS:
+        return jsonify({"Error": f"At most {ENROLLMENT_MAX_IDS} students can be changed per request"}), 413
+    students = {uid: u for uid, u in repos.users.get_multi(all_ids).items() if u.get('role') == 'student'}
+    if not all_ids.issubset(students):
+        return jsonify({"Error": "Enrollment data is invalid"}), 409
+
+    # Each backend applies the change without a read-modify-write of the
+    # rosters (one row or entity per enrollment), so concurrent roster
+    # edits don't overwrite each other. A course deleted since it was
+    # fetched refuses the change.
+    try:
+        repos.enrollments.apply(changes, courses, students)
+    except CourseDeleted:
+        return jsonify({"Error": "Enrollment data is invalid"}), 409
+    return '', 200
+
+
 ## Functionality: Get enrollment for a course
 ## Endpoint: GET /courses/:id/students
 ## Protection: Admin. Or instructor of the course.
 ## Description: All students enrolled in the course.
 @courses_bp.route('/courses/<int:course_id>/students', methods=['GET'])
 def get_enrollment(course_id):
-    client = datastore.Client()
+    repos = get_repositories()
 
     # Authentication
     payload = verify_jwt(request)
     if payload is None:
         return jsonify({"Error": "Unauthorized"}), 401
 
-    sub = payload['sub']
-    user = next((u for u in client.query(kind='users').fetch() if u.get('sub') == sub), None)
-
-    # Fetch course
-    course_key = client.key('courses', course_id)
-    course = client.get(course_key)
-    if not user or not course:
+    # Fetch course while the requester is resolved
+    course_future = submit(repos.courses.get, course_id)
+    user = get_principal(payload)
+    course = course_future.result()
+    if not user or not course or course.get('deleted'):
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     # Authorization
-    is_admin = user.get('role') == 'admin'
-    is_instructor = course.get('instructor_id') == user.key.id
+    is_admin = user.role == 'admin'
+    is_instructor = course.get('instructor_id') == user.id
     if not (is_admin or is_instructor):
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     # Return enrolled students
-    student_ids = course.get('students', [])
+    student_ids = repos.enrollments.students_of(course_id, course)
     return jsonify(student_ids), 200
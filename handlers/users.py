@@ -1,16 +1,18 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
 import requests
-import os
-from google.cloud import datastore
 from utils import verify_jwt, AuthError
-import io
+from principals import get_principal
+from repositories import get_repositories, MissingUpload
+from auth0 import request_token
+from concurrency import submit
+from fieldsets import parse_fields, select_fields, parse_ids, USER_FIELDS, USER_LIST_FIELDS
+from avatars import (pick_variant, avatar_blob_name, InvalidImage,
+                     AVATAR_MAX_UPLOAD_BYTES, AVATAR_SERVING_MODE)
 
 users_bp = Blueprint('users', __name__, url_prefix='/users')
-
-AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
-CLIENT_ID = os.getenv('AUTH0_CLIENT_ID')
-CLIENT_SECRET = os.getenv('AUTH0_CLIENT_SECRET')
-BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
+# Routes under /users that aren't a path segment below it (POST /users:batchGet)
+users_batch_bp = Blueprint('users_batch', __name__)
 
 
 ## Functionality: User login
@@ -24,24 +26,19 @@ def login():
     if not data or 'username' not in data or 'password' not in data:
         return jsonify({"Error": "The request body is invalid"}), 400
 
-    # Build the payload for Auth0 login request
-    payload = {
-        "grant_type": "password",
-        "username": data['username'],
-        "password": data['password'],
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "scope": "openid profile email"
-    }
-
-    headers = {'content-type': 'application/json'}
-    url = f'https://{AUTH0_DOMAIN}/oauth/token'
-    resp = requests.post(url, json=payload, headers=headers)
+    # Request a token from Auth0 over the shared session
+    try:
+        status, body = request_token(data['username'], data['password'])
+    except requests.RequestException:
+        return jsonify({"Error": "Authentication service unavailable"}), 503
 
-    if resp.status_code != 200:
+    # An Auth0 outage isn't the caller's bad credentials
+    if status >= 500:
+        return jsonify({"Error": "Authentication service unavailable"}), 503
+    if status != 200:
         return jsonify({"Error": "Unauthorized"}), 401
 
-    token = resp.json().get('id_token') or resp.json().get('access_token')
+    token = body.get('id_token') or body.get('access_token')
     if not token:
         return jsonify({"Error": "Unauthorized"}), 401
 
@@ -52,30 +49,33 @@ def login():
 ## Endpoint: GET /users
 ## Protection: Admin only
 ## Description: Summary information of all 9 users. No info 
-## about avatar or courses.
+## about avatar or courses. ?fields= picks from id, sub and role.
 @users_bp.route('', methods=['GET'])
 def get_all_users():
     payload = verify_jwt(request)
-    sub = payload['sub']
-
-    client = datastore.Client()
-    query = client.query(kind='users')
-    users = list(query.fetch())
 
     # Confirm the requester is an admin user
-    user = next((u for u in users if u['sub'] == sub), None)
-    if not user or user.get('role') != 'admin':
+    user = get_principal(payload)
+    if not user or user.role != 'admin':
         raise AuthError({
             "code": "forbidden",
             "description": "You don't have permission on this resource"
         }, 403)
 
+    try:
+        fields = parse_fields(request.args, USER_LIST_FIELDS)
+    except ValueError:
+        return jsonify({"Error": "The fields are invalid"}), 400
+
+    # With fields=, only the listed properties are read
+    users = get_repositories().users.list(fields)
+
     # Return minimal info (no avatar or courses)
-    result = [{
-        "id": u.key.id,
-        "sub": u['sub'],
-        "role": u['role']
-    } for u in users]
+    result = [select_fields({
+        "id": u['id'],
+        "sub": u.get('sub'),
+        "role": u.get('role')
+    }, fields) for u in users]
 
     return jsonify(result), 200
 
@@ -84,71 +84,165 @@ def get_all_users():
 ## Endpoint: GET /users/:id
 ## Protection: Admin. Or user with JWT matching id
 ## Description: Detailed info about the user, including
-## avatar (if any) and courses (for instructors and students)
+## avatar (if any) and courses (for instructors and students).
+## ?fields= limits the response; courses are only looked up if asked for.
 @users_bp.route('/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     payload = verify_jwt(request)
     requester_sub = payload['sub']
 
-    client = datastore.Client()
-    key = client.key('users', user_id)
-    user = client.get(key)
+    try:
+        fields = parse_fields(request.args, USER_FIELDS)
+    except ValueError:
+        return jsonify({"Error": "The fields are invalid"}), 400
+    want_courses = fields is None or 'courses' in fields
+
+    # Fetch the user while the requester is resolved
+    repos = get_repositories()
+    user_future = submit(repos.users.get, user_id)
+    requester = get_principal(payload)
+
+    # A user reading their own profile already told us their role, so the
+    # course lookup needn't wait for the user fetch
+    courses_future = None
+    if want_courses and requester and requester.id == user_id:
+        courses_future = submit(course_ids_for, repos, user_id, requester.role)
+
+    user = user_future.result()
     if not user:
         return jsonify({"Error": "Not found"}), 404
 
     # Verify the requester has access (self or admin)
-    requester = next(
-        (u for u in client.query(kind='users').fetch() if u['sub'] == requester_sub),
-        None
-    )
-    if not requester or (requester['role'] != 'admin' and requester_sub != user['sub']):
+    if not requester or (requester.role != 'admin' and requester_sub != user['sub']):
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
+    # Attach course URLs based on role (id-only lookups)
+    course_ids = None
+    if want_courses:
+        if courses_future is None or requester.role != user['role']:
+            course_ids = course_ids_for(repos, user_id, user['role'])
+        else:
+            course_ids = courses_future.result()
+
+    result = user_json(user, request.host_url.rstrip('/'), course_ids)
+    return jsonify(select_fields(result, fields)), 200
+
+
+## Functionality: Get many users
+## Endpoint: POST /users:batchGet
+## Protection: Admin only
+## Description: Body {"ids": [1, 2, 3]}. The users come back in the
+## order asked for, each as GET /users/:id returns it, all read with one
+## get_multi. Missing users get {"id", "Error"} in their place. Takes
+## ?fields= like GET /users/:id.
+@users_batch_bp.route('/users:batchGet', methods=['POST'])
+def batch_get_users():
+    payload = verify_jwt(request)
+
+    # Confirm the requester is an admin user
+    requester = get_principal(payload)
+    if not requester or requester.role != 'admin':
+        raise AuthError({
+            "code": "forbidden",
+            "description": "You don't have permission on this resource"
+        }, 403)
+
+    content = request.get_json(silent=True)
+    try:
+        ids = parse_ids(content.get('ids') if isinstance(content, dict) else None)
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+    try:
+        fields = parse_fields(request.args, USER_FIELDS)
+    except ValueError:
+        return jsonify({"Error": "The fields are invalid"}), 400
+
+    repos = get_repositories()
+    found = repos.users.get_multi(ids)
+
+    # Course lookups for the users found run side by side
+    course_futures = {}
+    if fields is None or 'courses' in fields:
+        course_futures = {uid: submit(course_ids_for, repos, uid, u['role'])
+                          for uid, u in found.items()}
+
+    host = request.host_url.rstrip('/')
+    users = []
+    for user_id in ids:
+        user = found.get(user_id)
+        if not user:
+            users.append({"id": user_id, "Error": "Not found"})
+            continue
+        future = course_futures.get(user_id)
+        course_ids = future.result() if future else None
+        users.append(select_fields(user_json(user, host, course_ids), fields))
+    return jsonify({"users": users}), 200
+
+
+# Response body for a user record, with course URLs if course_ids is given
+def user_json(user, host, course_ids=None):
     result = {
-        "id": user_id,
+        "id": user['id'],
         "sub": user['sub'],
         "role": user['role']
     }
 
-    # Check if an avatar exists for the user in GCS
-    if BUCKET_NAME:
-        try:
-            from google.cloud import storage
-            storage_client = storage.Client()
-            bucket = storage_client.bucket(BUCKET_NAME)
-            blob = bucket.blob(f'avatars/{user_id}.png')
-            if blob.exists():
-                host = request.host_url.rstrip('/')
-                result["avatar_url"] = f"{host}/users/{user_id}/avatar"
-        except Exception:
-            pass  # Don't block the request if GCS check fails
-
-    # Attach course URLs based on role
-    if user['role'] == 'instructor':
-        query = client.query(kind='courses')
-        result["courses"] = [
-            f"http://localhost:8080/courses/{c.key.id}"
-            for c in query.fetch()
-            if c.get('instructor_id') == user_id
-        ]
-    elif user['role'] == 'student':
-        query = client.query(kind='courses')
-        result["courses"] = [
-            f"http://localhost:8080/courses/{c.key.id}"
-            for c in query.fetch()
-            if user_id in c.get('students', [])
-        ]
+    # Avatar metadata is kept with the user, so no GCS call is needed
+    if user.get('avatar'):
+        result["avatar_url"] = f"{host}/users/{user['id']}/avatar"
 
-    return jsonify(result), 200
+    if course_ids is not None:
+        result["courses"] = [f"{host}/courses/{cid}" for cid in course_ids]
+    return result
+
+
+# Ids of the courses a user teaches or takes; None for roles without courses
+def course_ids_for(repos, user_id, role):
+    if role == 'instructor':
+        return repos.courses.ids_for_instructor(user_id)
+    if role == 'student':
+        return repos.enrollments.courses_of(user_id)
+    return None
+
+
+# Request body that fails once more than `limit` bytes have been read.
+# Chunked uploads have no Content-Length to check up front.
+class CappedStream:
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self._left = limit
+
+    def _count(self, data):
+        self._left -= len(data)
+        if self._left < 0:
+            raise RequestEntityTooLarge()
+        return data
+
+    def read(self, size=-1):
+        return self._count(self._stream.read(size))
+
+    def readline(self, size=-1):
+        return self._count(self._stream.readline(size))
 
 
 ## Functionality: Create/update a user’s avatar
 ## Endpoint: POST /users/:id/avatar
 ## Protection: User with JWT matching id
-## Description: Upload file to Google Cloud Storage.
+## Description: Upload file to Google Cloud Storage. The image is
+## validated and stored with 32/128/512px WebP and PNG variants.
 @users_bp.route('/<int:user_id>/avatar', methods=['POST'])
 def upload_avatar(user_id):
-    avatar_file = request.files.get('file')
+    if request.content_length and request.content_length > AVATAR_MAX_UPLOAD_BYTES:
+        return jsonify({"Error": "The request body is too large"}), 413
+    if request.content_length is None:
+        # The form hasn't been read yet, so this caps the whole body
+        request.environ['wsgi.input'] = CappedStream(request.environ['wsgi.input'],
+                                                     AVATAR_MAX_UPLOAD_BYTES)
+
+    try:
+        avatar_file = request.files.get('file')
+    except RequestEntityTooLarge:
+        return jsonify({"Error": "The request body is too large"}), 413
     if avatar_file is None or avatar_file.filename == '':
         return jsonify({"Error": "The request body is invalid"}), 400
 
@@ -157,8 +251,8 @@ def upload_avatar(user_id):
         return jsonify({"Error": "Unauthorized"}), 401
 
     requester_sub = payload['sub']
-    client = datastore.Client()
-    user = client.get(client.key('users', user_id))
+    repos = get_repositories()
+    user = repos.users.get(user_id)
     if not user:
         return jsonify({"Error": "Not found"}), 404
 
@@ -166,15 +260,90 @@ def upload_avatar(user_id):
     if user['sub'] != requester_sub:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    if not BUCKET_NAME:
+    if not repos.avatars.is_configured():
         return jsonify({"Error": "Server misconfiguration"}), 500
 
-    # Upload the avatar file to GCS
-    from google.cloud import storage
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f'avatars/{user_id}.png')
-    blob.upload_from_file(avatar_file, content_type=avatar_file.content_type)
+    # Validate the image and store it with its size variants
+    try:
+        metadata = repos.avatars.save(user_id, avatar_file.stream)
+    except InvalidImage:
+        return jsonify({"Error": "The request body is invalid"}), 400
+    repos.users.set_avatar(user_id, metadata)
+    repos.avatars.invalidate(user_id)
+
+    avatar_url = f"{request.host_url.rstrip('/')}/users/{user_id}/avatar"
+    return jsonify({"avatar_url": avatar_url}), 200
+
+
+## Functionality: Request a direct avatar upload
+## Endpoint: POST /users/:id/avatar/upload-url
+## Protection: User with JWT matching id
+## Description: Returns a short-lived signed URL the client PUTs the image
+## to; finish with POST /users/:id/avatar/complete.
+@users_bp.route('/<int:user_id>/avatar/upload-url', methods=['POST'])
+def get_avatar_upload_url(user_id):
+    payload = verify_jwt(request)
+    if not payload:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    content = request.get_json(silent=True) or {}
+    content_type = content.get('content_type', 'image/png')
+    if not isinstance(content_type, str) or not content_type.startswith('image/'):
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    repos = get_repositories()
+    user = repos.users.get(user_id)
+    if not user:
+        return jsonify({"Error": "Not found"}), 404
+
+    if user['sub'] != payload['sub']:
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    if not repos.avatars.is_configured():
+        return jsonify({"Error": "Server misconfiguration"}), 500
+
+    if not repos.avatars.supports_signed_urls:
+        return jsonify({"Error": "Direct uploads are not available"}), 501
+
+    url, headers, expires_in = repos.avatars.signed_upload(user_id, content_type)
+    return jsonify({
+        "upload_url": url,
+        "method": "PUT",
+        "headers": headers,
+        "expires_in": expires_in
+    }), 200
+
+
+## Functionality: Finish a direct avatar upload
+## Endpoint: POST /users/:id/avatar/complete
+## Protection: User with JWT matching id
+## Description: Validates the image uploaded through the signed URL and
+## generates its variants, like POST /users/:id/avatar.
+@users_bp.route('/<int:user_id>/avatar/complete', methods=['POST'])
+def complete_avatar_upload(user_id):
+    payload = verify_jwt(request)
+    if not payload:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    repos = get_repositories()
+    user = repos.users.get(user_id)
+    if not user:
+        return jsonify({"Error": "Not found"}), 404
+
+    if user['sub'] != payload['sub']:
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    if not repos.avatars.is_configured():
+        return jsonify({"Error": "Server misconfiguration"}), 500
+
+    try:
+        metadata = repos.avatars.process_staged(user_id)
+    except MissingUpload:
+        return jsonify({"Error": "Not found"}), 404
+    except InvalidImage:
+        return jsonify({"Error": "The request body is invalid"}), 400
+    repos.users.set_avatar(user_id, metadata)
+    repos.avatars.invalidate(user_id)
 
     avatar_url = f"{request.host_url.rstrip('/')}/users/{user_id}/avatar"
     return jsonify({"avatar_url": avatar_url}), 200
@@ -184,6 +353,8 @@ def upload_avatar(user_id):
 ## Endpoint: GET /users/:id/avatar
 ## Protection: User with JWT matching id
 ## Description: Read and return file from Google Cloud Storage.
+## ?size=N returns the closest pre-generated variant. With
+## AVATAR_SERVING_MODE=redirect, answers with a signed GCS URL instead.
 @users_bp.route('/<int:user_id>/avatar', methods=['GET'])
 def get_avatar(user_id):
     payload = verify_jwt(request)
@@ -191,33 +362,37 @@ def get_avatar(user_id):
         return jsonify({"Error": "Missing or invalid JWT"}), 401
 
     requester_sub = payload['sub']
-    client = datastore.Client()
-    user = client.get(client.key('users', user_id))
+    repos = get_repositories()
+    user = repos.users.get(user_id)
     if not user:
         return jsonify({"Error": "Not found"}), 404
 
     if user['sub'] != requester_sub:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    if not BUCKET_NAME:
+    if not repos.avatars.is_configured():
         return jsonify({"Error": "Server misconfiguration"}), 500
 
-    # Retrieve the image file from GCS and stream it back
-    from google.cloud import storage
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f'avatars/{user_id}.png')
-
-    if not blob.exists():
+    avatar = user.get('avatar')
+    if not avatar:
         return jsonify({"Error": "Not found"}), 404
 
-    image_bytes = blob.download_as_bytes()
-    return send_file(
-        io.BytesIO(image_bytes),
-        mimetype='image/png',
-        as_attachment=False,
-        download_name=f'user_{user_id}_avatar.png'
-    )
+    # Pick the blob: a resized variant when ?size= is given
+    name, mimetype = avatar_blob_name(user_id), 'image/png'
+    generation = avatar['generation']
+    size = request.args.get('size', type=int)
+    if size:
+        name, mimetype, key = pick_variant(user_id, size, request.headers.get('Accept'))
+        generation = avatar.get('variants', {}).get(key)
+
+    # Either redirect to a signed GCS URL or stream the bytes back
+    if AVATAR_SERVING_MODE == 'redirect' and repos.avatars.supports_signed_urls:
+        resp = repos.avatars.redirect(name)
+    else:
+        resp = repos.avatars.serve(user_id, name, mimetype, generation)
+    if size and not isinstance(resp, tuple):
+        resp.vary.add('Accept')
+    return resp
 
 
 ## Functionality: Delete a user’s avatar
@@ -231,25 +406,22 @@ def delete_avatar(user_id):
         return jsonify({"Error": "Missing or invalid JWT"}), 401
 
     requester_sub = payload['sub']
-    client = datastore.Client()
-    user = client.get(client.key('users', user_id))
+    repos = get_repositories()
+    user = repos.users.get(user_id)
     if not user:
         return jsonify({"Error": "Not found"}), 404
 
     if user['sub'] != requester_sub:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    if not BUCKET_NAME:
+    if not repos.avatars.is_configured():
         return jsonify({"Error": "Server misconfiguration"}), 500
 
-    # Remove the avatar blob from GCS if it exists
-    from google.cloud import storage
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f'avatars/{user_id}.png')
-
-    if not blob.exists():
+    # Remove the avatar and its variants if it exists
+    deleted = repos.avatars.delete(user_id)
+    repos.avatars.invalidate(user_id)
+    if user.get('avatar'):
+        repos.users.set_avatar(user_id, None)
+    elif not deleted:
         return jsonify({"Error": "Not found"}), 404
-
-    blob.delete()
     return '', 204
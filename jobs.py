@@ -0,0 +1,275 @@
+# jobs.py
+import os
+import queue
+import logging
+import datetime
+import threading
+from google.cloud import datastore
+from google.cloud.datastore.query import PropertyFilter
+
+# Jobs default to Datastore only when the API's data lives there
+JOB_BACKEND = os.getenv("JOB_BACKEND") or (
+    "datastore" if os.getenv("STORAGE_BACKEND", "datastore") == "datastore" else "memory")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "2"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+# Seconds between scans for jobs whose worker died (expired leases)
+JOB_SWEEP_INTERVAL = float(os.getenv("JOB_SWEEP_INTERVAL", "60"))
+
+logger = logging.getLogger(__name__)
+
+# Job states
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class MemoryJobBackend:
+    # Keeps jobs in process memory; work is lost if the process exits
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def save(self, job):
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+
+    def load(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def claim(self, job_id, lease_seconds):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or not _claimable(job):
+                return None
+            _start_attempt(job, lease_seconds)
+            return dict(job)
+
+    def unfinished(self):
+        with self._lock:
+            return [job_id for job_id, job in self._jobs.items() if _claimable(job)]
+
+
+class DatastoreJobBackend:
+    # Persists jobs in the `jobs` kind so another worker can pick up
+    # anything left behind when a process dies mid-job
+    kind = 'jobs'
+
+    def __init__(self, client_factory):
+        self._client_factory = client_factory
+
+    def _key(self, client, job_id):
+        return client.key(self.kind, job_id)
+
+    def save(self, job):
+        client = self._client_factory()
+        entity = datastore.Entity(key=self._key(client, job['id']),
+                                  exclude_from_indexes=('params', 'error'))
+        entity.update({k: v for k, v in job.items() if k != 'id'})
+        client.put(entity)
+
+    def load(self, job_id):
+        client = self._client_factory()
+        entity = client.get(self._key(client, job_id))
+        if entity is None:
+            return None
+        return dict(entity, id=job_id)
+
+    def claim(self, job_id, lease_seconds):
+        client = self._client_factory()
+        with client.transaction():
+            entity = client.get(self._key(client, job_id))
+            if entity is None or not _claimable(entity):
+                return None
+            _start_attempt(entity, lease_seconds)
+            client.put(entity)
+        return dict(entity, id=job_id)
+
+    def unfinished(self):
+        client = self._client_factory()
+        job_ids = []
+        for status in (PENDING, RUNNING):
+            query = client.query(kind=self.kind)
+            query.add_filter(filter=PropertyFilter('status', '=', status))
+            job_ids += [e.key.name for e in query.fetch() if _claimable(e)]
+        return job_ids
+
+
+def _claimable(job):
+    if job['status'] == PENDING:
+        return True
+    # A running job whose lease ran out belonged to a worker that died
+    return job['status'] == RUNNING and job.get('lease_until') and job['lease_until'] < _now()
+
+
+def _start_attempt(job, lease_seconds):
+    job['status'] = RUNNING
+    job['attempts'] = job.get('attempts', 0) + 1
+    job['lease_until'] = _now() + datetime.timedelta(seconds=lease_seconds)
+    job['updated'] = _now()
+
+
+class Job(dict):
+    # Handed to job handlers; report() records progress and renews the lease
+    def __init__(self, data, backend, lease_seconds):
+        super().__init__(data)
+        self._backend = backend
+        self._lease_seconds = lease_seconds
+
+    def report(self, processed, total=None):
+        self['processed'] = processed
+        if total is not None:
+            self['total'] = total
+        self['lease_until'] = _now() + datetime.timedelta(seconds=self._lease_seconds)
+        self['updated'] = _now()
+        self._backend.save(self)
+
+
+class JobQueue:
+    # In-process queue with one background worker thread per process.
+    # Job state lives in a pluggable backend; handlers must be idempotent
+    # because a job may run again after a crash or a failed attempt.
+    def __init__(self, backend, max_attempts=JOB_MAX_ATTEMPTS,
+                 retry_delay=JOB_RETRY_DELAY, lease_seconds=JOB_LEASE_SECONDS,
+                 sweep_interval=JOB_SWEEP_INTERVAL):
+        self.backend = backend
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self.sweep_interval = sweep_interval
+        self._handlers = {}
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._sweeping = False
+
+    def register(self, job_type, handler):
+        self._handlers[job_type] = handler
+
+    def enqueue(self, job_type, job_id, params, total=0):
+        job = {
+            'id': job_id,
+            'type': job_type,
+            'status': PENDING,
+            'params': params,
+            'processed': 0,
+            'total': total,
+            'attempts': 0,
+            'error': None,
+            'lease_until': None,
+            'created': _now(),
+            'updated': _now()
+        }
+        self.backend.save(job)
+        self._submit(job_id)
+        return job
+
+    def get(self, job_id):
+        return self.backend.load(job_id)
+
+    def resume(self, job_id):
+        # Queue an existing job again; it only runs if it is claimable
+        # (pending, or running on a lease that ran out)
+        self._submit(job_id)
+
+    def start(self):
+        # Start the worker and pick up jobs other processes left unfinished.
+        # A dead worker's job still holds its lease at this point, so the
+        # scan is repeated every sweep_interval seconds to catch it once
+        # the lease has run out.
+        self._ensure_worker()
+        self._resume_unfinished()
+        with self._lock:
+            if self._sweeping or self.sweep_interval <= 0:
+                return
+            self._sweeping = True
+        self._schedule_sweep()
+
+    def _resume_unfinished(self):
+        try:
+            for job_id in self.backend.unfinished():
+                self._queue.put(job_id)
+        except Exception:
+            logger.exception("Could not resume unfinished jobs")
+
+    def _schedule_sweep(self):
+        timer = threading.Timer(self.sweep_interval, self._sweep)
+        timer.daemon = True
+        timer.start()
+
+    def _sweep(self):
+        self._resume_unfinished()
+        self._schedule_sweep()
+
+    def _submit(self, job_id):
+        self._ensure_worker()
+        self._queue.put(job_id)
+
+    def _ensure_worker(self):
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, daemon=True)
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception:
+                logger.exception("Job %s could not be run", job_id)
+
+    def _run(self, job_id):
+        data = self.backend.claim(job_id, self.lease_seconds)
+        if data is None:
+            return  # finished, or leased by another worker
+        job = Job(data, self.backend, self.lease_seconds)
+        try:
+            self._handlers[job['type']](job)
+        except Exception as e:
+            logger.exception("Job %s failed (attempt %d)", job_id, job['attempts'])
+            job['error'] = str(e)
+            job['lease_until'] = None
+            job['updated'] = _now()
+            if job['attempts'] < self.max_attempts:
+                job['status'] = PENDING
+                self.backend.save(job)
+                delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+                timer = threading.Timer(delay, self._submit, args=[job_id])
+                timer.daemon = True
+                timer.start()
+            else:
+                job['status'] = FAILED
+                self.backend.save(job)
+            return
+
+        job['status'] = DONE
+        job['error'] = None
+        job['lease_until'] = None
+        job['updated'] = _now()
+        self.backend.save(job)
+
+
+def make_backend(name=JOB_BACKEND):
+    if name == 'memory':
+        return MemoryJobBackend()
+    from clients import get_datastore_client
+    return DatastoreJobBackend(get_datastore_client)
+
+
+job_queue = JobQueue(make_backend())
@@ -1,6 +1,7 @@
 from flask import Flask, jsonify
 from utils import AuthError
-from handlers.users import users_bp
+import metrics
+from handlers.users import users_bp, users_batch_bp
 from handlers.courses import courses_bp
 
 # Initialize the Flask application
@@ -8,8 +9,12 @@ app = Flask(__name__)
 
 # Register user and course blueprints
 app.register_blueprint(users_bp)
+app.register_blueprint(users_batch_bp)
 app.register_blueprint(courses_bp)
 
+# Per-request timings, Server-Timing headers and GET /metrics
+metrics.init_app(app)
+
 # Root route to verify the service is running
 @app.route('/')
 def index():
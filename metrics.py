@@ -0,0 +1,333 @@
+# metrics.py
+import os
+import re
+import hmac
+import time
+import random
+import cProfile
+import tempfile
+import threading
+import functools
+import contextvars
+from collections import defaultdict
+from flask import g, request, Response
+from flask.json.provider import DefaultJSONProvider
+from prometheus_client import (Counter, Gauge, Histogram, CollectorRegistry, REGISTRY,
+                               CONTENT_TYPE_LATEST, generate_latest, multiprocess)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Bearer token GET /metrics requires. Without one the endpoint refuses
+# every request, unless METRICS_PUBLIC=true opts out of protection.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "false").lower() == "true"
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
+# Profile this fraction of requests; keep the profile if the request took
+# at least PROFILE_SLOW_MS. A rate of 0 turns profiling off.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "500"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "tarpaulin-profiles"))
+
+REQUEST_SECONDS = Histogram(
+    'tarpaulin_request_seconds', 'Request wall time', ['method', 'route', 'status'])
+PHASE_SECONDS = Histogram(
+    'tarpaulin_request_phase_seconds', 'Request time spent per phase', ['route', 'phase'])
+REQUEST_DATASTORE_OPS = Histogram(
+    'tarpaulin_request_datastore_operations', 'Datastore operations per request', ['route', 'kind'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500))
+DATASTORE_OPERATIONS = Counter(
+    'tarpaulin_datastore_operations_total', 'Datastore operations', ['op'])
+DATASTORE_ENTITIES = Counter(
+    'tarpaulin_datastore_entities_total', 'Entities returned by or written to Datastore', ['direction'])
+EXTERNAL_SECONDS = Histogram(
+    'tarpaulin_external_call_seconds', 'Time to response headers for calls to other services', ['service'])
+TOKEN_CACHE_EVENTS = Counter(
+    'tarpaulin_token_cache_events_total', 'Verified-token cache lookups and evictions', ['event'])
+TOKEN_CACHE_ENTRIES = Gauge(
+    'tarpaulin_token_cache_entries', 'Verified tokens held', multiprocess_mode='livesum')
+AVATAR_CACHE_EVENTS = Counter(
+    'tarpaulin_avatar_cache_events_total', 'Avatar cache hits, misses (tier "none") and revalidations', ['tier', 'event'])
+AVATAR_CACHE_SERVED_BYTES = Counter(
+    'tarpaulin_avatar_cache_served_bytes_total', 'Avatar bytes served from the cache', ['tier'])
+AVATAR_CACHE_BYTES = Gauge(
+    'tarpaulin_avatar_cache_bytes', 'Avatar bytes held in the cache', ['tier'], multiprocess_mode='livesum')
+
+# Datastore operations that read vs. write
+READ_OPS = {'get', 'get_multi', 'query'}
+
+
+class RequestStats:
+    # What one request spent its time on. Updated from the fan-out pool
+    # too, hence the lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.reads = 0
+        self.writes = 0
+        self.entities = 0
+        self.calls = defaultdict(int)
+
+
+# Held in a context variable rather than flask.g so calls made from
+# concurrency.submit() are charged to the request that started them
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+def current():
+    return _current.get()
+
+
+def record_phase(phase, seconds):
+    stats = current()
+    if stats is not None:
+        with stats.lock:
+            stats.phases[phase] += seconds
+
+
+def record_datastore(op, seconds, entities=0):
+    DATASTORE_OPERATIONS.labels(op).inc()
+    direction = 'read' if op in READ_OPS else 'written'
+    if entities:
+        DATASTORE_ENTITIES.labels(direction).inc(entities)
+    stats = current()
+    if stats is not None:
+        with stats.lock:
+            stats.phases['datastore'] += seconds
+            stats.entities += entities
+            if op in READ_OPS:
+                stats.reads += 1
+            elif op != 'allocate_ids':
+                stats.writes += 1
+
+
+def record_external(service, seconds):
+    EXTERNAL_SECONDS.labels(service).observe(seconds)
+    stats = current()
+    if stats is not None:
+        with stats.lock:
+            stats.phases[service] += seconds
+            stats.calls[service] += 1
+
+
+def timed(phase):
+    # Decorator charging a function's time to a request phase
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record_phase(phase, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def response_hook(service):
+    # requests response hook timing calls made through a Session
+    def hook(resp, *args, **kwargs):
+        record_external(service, resp.elapsed.total_seconds())
+    return hook
+
+
+class _TimedIterator:
+    # Query results, timed as they are pulled (queries page lazily)
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._it = iter(iterator)
+        self._entities = 0
+        self._seconds = 0.0
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self._it)
+        except StopIteration:
+            self._finish(time.perf_counter() - start)
+            raise
+        self._seconds += time.perf_counter() - start
+        self._entities += 1
+        return item
+
+    def _finish(self, seconds):
+        if not self._done:
+            self._done = True
+            record_datastore('query', self._seconds + seconds, self._entities)
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
+
+
+class _InstrumentedQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def fetch(self, *args, **kwargs):
+        return _TimedIterator(self._query.fetch(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+
+class InstrumentedDatastoreClient:
+    # Wraps a datastore.Client to count operations and entities. Everything
+    # else (keys, transactions, ...) is passed through.
+    def __init__(self, client):
+        self._client = client
+
+    def _call(self, op, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        if op == 'get':
+            entities = 1 if result is not None else 0
+        elif op == 'get_multi':
+            entities = len(result)
+        elif op == 'put_multi':
+            entities = len(args[0]) if args else len(kwargs.get('entities', []))
+        elif op == 'put':
+            entities = 1
+        else:
+            entities = 0
+        record_datastore(op, time.perf_counter() - start, entities)
+        return result
+
+    def get(self, *args, **kwargs):
+        return self._call('get', self._client.get, *args, **kwargs)
+
+    def get_multi(self, *args, **kwargs):
+        return self._call('get_multi', self._client.get_multi, *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self._call('put', self._client.put, *args, **kwargs)
+
+    def put_multi(self, *args, **kwargs):
+        return self._call('put_multi', self._client.put_multi, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._call('delete', self._client.delete, *args, **kwargs)
+
+    def delete_multi(self, *args, **kwargs):
+        return self._call('delete_multi', self._client.delete_multi, *args, **kwargs)
+
+    def allocate_ids(self, *args, **kwargs):
+        return self._call('allocate_ids', self._client.allocate_ids, *args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        return _InstrumentedQuery(self._client.query(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    # Charges JSON encoding of responses to the "serialize" phase
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            record_phase('serialize', time.perf_counter() - start)
+
+
+_profile_lock = threading.Lock()
+
+
+def _start_request():
+    g.request_stats_token = _current.set(RequestStats())
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE \
+            and _profile_lock.acquire(blocking=False):
+        # One profiled request per process at a time keeps overhead bounded
+        profiler = cProfile.Profile()
+        g.profiler = profiler
+        profiler.enable()
+
+
+def _stop_profiler():
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+    return profiler
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def server_timing(stats, total):
+    parts = []
+    for phase, seconds in sorted(stats.phases.items()):
+        entry = f'{phase};dur={seconds * 1000:.2f}'
+        if phase == 'datastore':
+            entry += f';desc="reads={stats.reads} writes={stats.writes} entities={stats.entities}"'
+        elif stats.calls.get(phase):
+            entry += f';desc="calls={stats.calls[phase]}"'
+        parts.append(entry)
+    app_seconds = max(total - sum(stats.phases.values()), 0.0)
+    parts.append(f'app;dur={app_seconds * 1000:.2f}')
+    parts.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(parts)
+
+
+def _finish_request(response):
+    stats = current()
+    if stats is None:
+        return response
+    profiler = _stop_profiler()
+    total = time.perf_counter() - stats.started
+    route = _route()
+
+    REQUEST_SECONDS.labels(request.method, route, str(response.status_code)).observe(total)
+    for phase, seconds in stats.phases.items():
+        PHASE_SECONDS.labels(route, phase).observe(seconds)
+    PHASE_SECONDS.labels(route, 'app').observe(max(total - sum(stats.phases.values()), 0.0))
+    REQUEST_DATASTORE_OPS.labels(route, 'read').observe(stats.reads)
+    REQUEST_DATASTORE_OPS.labels(route, 'write').observe(stats.writes)
+
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = server_timing(stats, total)
+
+    if profiler is not None and total * 1000 >= PROFILE_SLOW_MS:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        label = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+        name = f"{int(time.time())}-{os.getpid()}-{request.method}-{label}-{int(total * 1000)}ms.prof"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    return response
+
+
+def _teardown_request(exc):
+    # after_request is skipped on unhandled errors; never leave a profiler on
+    if g.get('profiler') is not None:
+        _stop_profiler()
+    token = g.pop('request_stats_token', None)
+    if token is not None:
+        _current.reset(token)
+
+
+def metrics_view():
+    # Route traffic and latencies aren't public: fail closed
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    elif not METRICS_PUBLIC:
+        return Response('Set METRICS_TOKEN to enable /metrics\n', status=403, mimetype='text/plain')
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Aggregate every gunicorn worker, not just the one answering
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    if not METRICS_ENABLED:
+        return
+    app.json = TimedJSONProvider(app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
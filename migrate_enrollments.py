@@ -0,0 +1,90 @@
+import sys
+from google.cloud import datastore
+from dotenv import load_dotenv
+from repositories.datastore import enrollment_key, enrolled
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Entities per commit (Datastore's limit)
+BATCH_SIZE = 500
+
+
+# Move one course's `students` array into the enrollments kind. Until it
+# is moved the array is the roster, so the course's enrollments are made
+# to match it exactly (extras from an interrupted run are deleted). The
+# last writes and the removal of the array commit together, and only if
+# the array hasn't changed since it was read; otherwise the course is
+# left for a later run. Returns (added, removed) or None if skipped.
+def move_roster(client, course, dry_run=False):
+    course_id = course.key.id
+    students = course['students'] or []
+    wanted = set(students)
+    existing = {sid for _, sid in enrolled(client, 'course_id', course_id)}
+
+    puts = []
+    for sid in wanted - existing:
+        enrollment = datastore.Entity(key=enrollment_key(client, course_id, sid))
+        enrollment.update({"course_id": course_id, "student_id": sid})
+        puts.append(enrollment)
+    deletes = [enrollment_key(client, course_id, sid) for sid in existing - wanted]
+    if dry_run:
+        return len(puts), len(deletes)
+
+    # Everything but the last commit can go ahead: it is keyed, so
+    # repeating it is harmless
+    mutations = [('put', e) for e in puts] + [('delete', k) for k in deletes]
+    last = max(len(mutations) - (BATCH_SIZE - 1), 0)
+    for start in range(0, last, BATCH_SIZE):
+        batch = mutations[start:min(start + BATCH_SIZE, last)]
+        client.put_multi([m for op, m in batch if op == 'put'])
+        client.delete_multi([m for op, m in batch if op == 'delete'])
+
+    with client.transaction():
+        current = client.get(course.key)
+        if current is None or current.get('students') != course['students']:
+            return None
+        batch = mutations[last:]
+        client.put_multi([m for op, m in batch if op == 'put'])
+        client.delete_multi([m for op, m in batch if op == 'delete'])
+        del current['students']
+        client.put(current)
+    return len(puts), len(deletes)
+
+
+# One-shot cutover from the `students`/`courses` arrays to the enrollments
+# kind. Courses already moved have no array and are never touched again,
+# so rerunning it (e.g. after an interruption) can't undo roster changes
+# made since through the enrollments kind.
+def migrate(dry_run=False):
+    client = datastore.Client()
+
+    added = removed = moved = 0
+    skipped = []
+    for course in client.query(kind='courses').fetch():
+        if 'students' not in course or course.get('deleted'):
+            # Already moved, or a tombstone whose cleanup job handles it
+            continue
+        result = move_roster(client, course, dry_run)
+        if result is None:
+            skipped.append(course.key.id)
+            continue
+        added, removed, moved = added + result[0], removed + result[1], moved + 1
+
+    # Students' `courses` arrays only mirrored the rosters
+    users = [u for u in client.query(kind='users').fetch() if 'courses' in u]
+    for user in users:
+        del user['courses']
+    if not dry_run:
+        for start in range(0, len(users), BATCH_SIZE):
+            client.put_multi(users[start:start + BATCH_SIZE])
+
+    verb = 'would be ' if dry_run else ''
+    print(f"{moved} roster(s) {verb}moved: {added} enrollment(s) added, {removed} removed")
+    print(f"{len(users)} user(s) {verb}stripped of their courses array")
+    for course_id in skipped:
+        print(f"Course {course_id}: roster changed during the move, run again once roster edits have stopped")
+
+
+if __name__ == "__main__":
+    migrate(dry_run='--dry-run' in sys.argv)
@@ -0,0 +1,73 @@
+# principals.py
+import os
+import time
+import threading
+from collections import namedtuple
+from flask import g
+from repositories import get_repositories
+
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+
+# The caller behind a verified JWT, as stored with the users
+Principal = namedtuple('Principal', ['id', 'sub', 'role'])
+
+
+class PrincipalCache:
+    # Process-wide sub -> Principal map with a fixed TTL per entry
+    def __init__(self, ttl=PRINCIPAL_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, sub):
+        with self._lock:
+            entry = self._entries.get(sub)
+            if entry is None:
+                return None
+            principal, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[sub]
+                return None
+            return principal
+
+    def put(self, principal):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[principal.sub] = (principal, time.monotonic() + self.ttl)
+
+    def invalidate(self, sub):
+        with self._lock:
+            self._entries.pop(sub, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache()
+
+
+def lookup_principal(sub):
+    user = get_repositories().users.find_by_sub(sub)
+    if user is None:
+        return None
+    return Principal(user['id'], sub, user.get('role'))
+
+
+def get_principal(payload):
+    # Resolve the caller once per request; later calls reuse flask.g
+    sub = payload['sub']
+    principal = g.get('principal')
+    if principal is not None and principal.sub == sub:
+        return principal
+
+    principal = principal_cache.get(sub)
+    if principal is None:
+        principal = lookup_principal(sub)
+        if principal is None:
+            return None
+        principal_cache.put(principal)
+
+    g.principal = principal
+    return principal
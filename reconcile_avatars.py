@@ -0,0 +1,66 @@
+import os
+import re
+import sys
+from google.cloud import datastore, storage
+from dotenv import load_dotenv
+from avatars import avatar_blob_name, avatar_metadata, variant_key
+
+# Load environment variables from .env file
+load_dotenv()
+
+BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
+
+ORIGINAL_RE = re.compile(r'^avatars/(\d+)\.png$')
+VARIANT_RE = re.compile(r'^avatars/(\d+)/(\d+)\.(\w+)$')
+
+
+# Group the bucket's avatar blobs by user id
+def list_avatar_blobs(bucket):
+    originals, variants = {}, {}
+    for blob in bucket.list_blobs(prefix='avatars/'):
+        match = ORIGINAL_RE.match(blob.name)
+        if match:
+            originals[int(match.group(1))] = blob
+            continue
+        match = VARIANT_RE.match(blob.name)
+        if match:
+            user_id, size, ext = int(match.group(1)), int(match.group(2)), match.group(3)
+            variants.setdefault(user_id, {})[variant_key(size, ext)] = blob
+    return originals, variants
+
+
+# Make each user's avatar metadata match what is actually in the bucket
+def reconcile(dry_run=False):
+    client = datastore.Client()
+    bucket = storage.Client().bucket(BUCKET_NAME)
+    originals, variants = list_avatar_blobs(bucket)
+
+    fixed = []
+    for user in client.query(kind='users').fetch():
+        user_id = user.key.id
+        current = user.get('avatar')
+        blob = originals.pop(user_id, None)
+        expected = avatar_metadata(blob, variants.get(user_id, {})) if blob else None
+
+        if current is None and expected is None:
+            continue
+        if current and expected and current.get('generation') == expected['generation'] \
+                and dict(current.get('variants') or {}) == expected['variants']:
+            continue
+
+        print(f"User {user_id}: {'clearing' if expected is None else 'updating'} avatar metadata")
+        user['avatar'] = expected
+        user.exclude_from_indexes.add('avatar')
+        fixed.append(user)
+
+    for user_id in originals:
+        print(f"Orphaned avatar {avatar_blob_name(user_id)} (no such user)")
+
+    if fixed and not dry_run:
+        for start in range(0, len(fixed), 500):
+            client.put_multi(fixed[start:start + 500])
+    print(f"{len(fixed)} user(s) {'would be ' if dry_run else ''}updated")
+
+
+if __name__ == "__main__":
+    reconcile(dry_run='--dry-run' in sys.argv)
@@ -0,0 +1,57 @@
+# repositories
+#
+# Storage behind the blueprints, selected with STORAGE_BACKEND:
+#   datastore - Cloud Datastore + Cloud Storage (default)
+#   memory    - per-process dicts, for tests and benchmarks
+#   sqlite    - a local SQLite file (SQLITE_PATH)
+import os
+import threading
+from collections import namedtuple
+from repositories.base import (UserRepo, CourseRepo, EnrollmentRepo, AvatarStore,
+                               MissingUpload, CourseDeleted, COURSE_FIELDS, BATCH_SIZE, FILTER_FIELDS,
+                               sort_field, sort_value, matches_filters)
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "datastore")
+
+Repositories = namedtuple('Repositories', ['users', 'courses', 'enrollments', 'avatars'])
+
+
+def make_repositories(name=STORAGE_BACKEND):
+    if name == 'memory':
+        from repositories.memory import (MemoryStore, MemoryUserRepo, MemoryCourseRepo,
+                                         MemoryEnrollmentRepo, MemoryAvatarStore)
+        store = MemoryStore()
+        return Repositories(MemoryUserRepo(store), MemoryCourseRepo(store),
+                            MemoryEnrollmentRepo(store), MemoryAvatarStore(store))
+    if name == 'sqlite':
+        from repositories.sqlite import (SQLiteDatabase, SQLiteUserRepo, SQLiteCourseRepo,
+                                         SQLiteEnrollmentRepo, SQLiteAvatarStore)
+        db = SQLiteDatabase()
+        return Repositories(SQLiteUserRepo(db), SQLiteCourseRepo(db),
+                            SQLiteEnrollmentRepo(db), SQLiteAvatarStore(db))
+    if name == 'datastore':
+        from repositories.datastore import (DatastoreUserRepo, DatastoreCourseRepo,
+                                            DatastoreEnrollmentRepo, GCSAvatarStore)
+        return Repositories(DatastoreUserRepo(), DatastoreCourseRepo(),
+                            DatastoreEnrollmentRepo(), GCSAvatarStore())
+    raise ValueError(f"unknown STORAGE_BACKEND {name!r}")
+
+
+_repositories = None
+_lock = threading.Lock()
+
+
+def get_repositories():
+    # Built on first use; the backends handle per-process clients themselves
+    global _repositories
+    with _lock:
+        if _repositories is None:
+            _repositories = make_repositories()
+        return _repositories
+
+
+def set_repositories(repositories):
+    # Swap the storage in use (e.g. a prepared memory store in a benchmark)
+    global _repositories
+    with _lock:
+        _repositories = repositories
@@ -0,0 +1,198 @@
+# repositories/base.py
+#
+# Storage interfaces the blueprints go through. Records are plain dicts
+# carrying their numeric "id"; anything else a backend stores for its own
+# bookkeeping stays inside the backend.
+#
+# users:   {"id", "sub", "role", "avatar"}
+# courses: {"id", "subject", "number", "title", "term", "instructor_id",
+#           "deleted", "removed_instructor_id", "removed_students"}
+
+# Course fields clients may set
+COURSE_FIELDS = ['subject', 'number', 'title', 'term', 'instructor_id']
+
+# Most records one batched write should touch (Datastore's commit limit)
+BATCH_SIZE = 500
+
+# Course fields listings can be filtered on by exact match. A number range
+# is given as number_min/number_max (inclusive).
+FILTER_FIELDS = ['subject', 'term', 'instructor_id']
+
+
+def sort_field(filters):
+    # Listings are ordered by (subject, id), or by (number, id) under a
+    # number range, since Datastore sorts on the range property first
+    if filters and ('number_min' in filters or 'number_max' in filters):
+        return 'number'
+    return 'subject'
+
+
+def sort_value(value):
+    # Sort key for a course field. Clients may store any JSON type, so
+    # values are ranked by type first, in Datastore's order (null, integers,
+    # booleans, strings, floats), and only compared within a type.
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (2, value)
+    if isinstance(value, int):
+        return (1, value)
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, float):
+        return (5, value)
+    return (6, str(value))
+
+
+def matches_filters(course, filters):
+    for name in FILTER_FIELDS:
+        if name in filters and course.get(name) != filters[name]:
+            return False
+    if 'number_min' in filters or 'number_max' in filters:
+        number = course.get('number')
+        if not isinstance(number, int):
+            return False
+        if number < filters.get('number_min', number) or number > filters.get('number_max', number):
+            return False
+    return True
+
+
+class MissingUpload(Exception):
+    # AvatarStore.process_staged found no uploaded image
+    pass
+
+
+class CourseDeleted(Exception):
+    # EnrollmentRepo.apply found a course missing or tombstoned
+    pass
+
+
+class UserRepo:
+    def get(self, user_id):
+        raise NotImplementedError
+
+    def get_multi(self, user_ids):
+        # {id: record} for the ids that exist
+        raise NotImplementedError
+
+    def find_by_sub(self, sub):
+        raise NotImplementedError
+
+    def create(self, fields):
+        # Store a user ({"sub", "role"}, optionally with an explicit "id")
+        raise NotImplementedError
+
+    def list(self, fields=None):
+        # With `fields`, records need only carry "id" and those fields
+        raise NotImplementedError
+
+    def scan(self, batch_size=BATCH_SIZE):
+        # Every user in id order, as lists of at most batch_size records
+        raise NotImplementedError
+
+    def set_avatar(self, user_id, metadata):
+        # Record avatar metadata; None clears it
+        raise NotImplementedError
+
+
+class CourseRepo:
+    def get(self, course_id):
+        # Tombstoned courses are returned too, with "deleted" set
+        raise NotImplementedError
+
+    def get_multi(self, course_ids):
+        raise NotImplementedError
+
+    def create(self, fields):
+        raise NotImplementedError
+
+    def create_multi(self, fields_list):
+        # Create several courses at once; records come back in input order.
+        # Callers keep each call within BATCH_SIZE.
+        raise NotImplementedError
+
+    def update(self, course_id, fields):
+        # Apply a partial update and return the full record
+        raise NotImplementedError
+
+    def list_page(self, limit, cursor=None, offset=None, filters=None, fields=None):
+        # Up to `limit` courses matching `filters`, ordered by
+        # (sort_field(filters), id), starting after the (value, id) `cursor`
+        # or skipping `offset` courses. With `fields`, records need only
+        # carry "id", the sort field and those fields.
+        raise NotImplementedError
+
+    def ids_for_instructor(self, user_id):
+        raise NotImplementedError
+
+    def scan(self, batch_size=BATCH_SIZE):
+        # Every live course in id order, as lists of at most batch_size
+        # records
+        raise NotImplementedError
+
+    def tombstone(self, course_id):
+        # Hide the course from listings and move its instructor/students
+        # into removed_instructor_id/removed_students for the cleanup job
+        raise NotImplementedError
+
+    def delete(self, course_id):
+        raise NotImplementedError
+
+
+class EnrollmentRepo:
+    def students_of(self, course_id, course=None):
+        # `course` is the course's record when the caller already has it
+        raise NotImplementedError
+
+    def courses_of(self, student_id):
+        # Ids of live courses the student is enrolled in
+        raise NotImplementedError
+
+    def rosters(self, courses):
+        # {course id: student ids} for a batch of course records
+        return {c['id']: self.students_of(c['id'], c) for c in courses}
+
+    def apply(self, changes, courses=None, students=None):
+        # changes: {course_id: (add_ids, remove_ids)}; ids already validated.
+        # courses/students: the {id: record} maps the caller validated
+        # against, which backends may reuse instead of reading again.
+        # Raises CourseDeleted if a course was tombstoned meanwhile, so no
+        # enrollment outlives its course's cleanup job.
+        raise NotImplementedError
+
+    def unlink_course(self, course_id, user_ids):
+        # Drop references to a deleted course held by these users
+        raise NotImplementedError
+
+
+class AvatarStore:
+    # Whether signed URLs (redirect mode, direct uploads) are available
+    supports_signed_urls = False
+
+    def is_configured(self):
+        return True
+
+    def serve(self, user_id, name, mimetype, generation=None):
+        # Flask response with the blob's bytes
+        raise NotImplementedError
+
+    def redirect(self, name):
+        raise NotImplementedError
+
+    def save(self, user_id, stream):
+        # Validate and store an upload with its variants; returns metadata
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        # False if there was nothing to delete
+        raise NotImplementedError
+
+    def signed_upload(self, user_id, content_type):
+        raise NotImplementedError
+
+    def process_staged(self, user_id):
+        # Raises MissingUpload if the client never PUT the image
+        raise NotImplementedError
+
+    def invalidate(self, user_id):
+        pass
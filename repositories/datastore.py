@@ -0,0 +1,357 @@
+# repositories/datastore.py
+#
+# Datastore + Cloud Storage backend, used in production.
+import os
+from google.cloud import datastore
+from google.cloud.datastore.query import PropertyFilter
+from google.api_core.exceptions import NotFound
+from clients import get_datastore_client, get_bucket
+from avatars import (stream_avatar, invalidate_avatar, redirect_to_avatar, gcs_writer,
+                     process_and_upload_avatar, delete_avatar_blobs, signed_upload,
+                     process_staged_upload)
+from repositories.base import (UserRepo, CourseRepo, EnrollmentRepo, AvatarStore,
+                               MissingUpload, CourseDeleted, COURSE_FIELDS, BATCH_SIZE,
+                               FILTER_FIELDS, sort_field)
+
+BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
+
+# Properties written without an index, per kind
+UNINDEXED = {
+    'users': ('avatar',),
+    'courses': ('removed_instructor_id', 'removed_students')
+}
+
+# Most values one IN filter may list
+IN_FILTER_SIZE = 30
+
+
+def to_record(entity):
+    if entity is None:
+        return None
+    record = dict(entity)
+    record['id'] = entity.key.id
+    return record
+
+
+def scan_kind(client, kind, batch_size):
+    # Key-ordered pages, each resumed from the previous page's cursor
+    cursor = None
+    while True:
+        pages = client.query(kind=kind).fetch(start_cursor=cursor, limit=batch_size)
+        batch = [to_record(e) for e in pages]
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        cursor = pages.next_page_token
+
+
+def enrollment_key(client, course_id, student_id):
+    return client.key('enrollments', f"{course_id}:{student_id}")
+
+
+def enrollment_ids(entity):
+    # (course id, student id) from an enrollment key; works on keys-only results
+    course_id, student_id = entity.key.name.split(':')
+    return int(course_id), int(student_id)
+
+
+def enrolled(client, name, value):
+    # Keys-only query over the enrollments kind; the ids are in the key names
+    query = client.query(kind='enrollments')
+    query.add_filter(filter=PropertyFilter(name, 'IN' if isinstance(value, list) else '=', value))
+    query.keys_only()
+    return [enrollment_ids(e) for e in query.fetch()]
+
+
+class DatastoreUserRepo(UserRepo):
+    def get(self, user_id):
+        client = get_datastore_client()
+        return to_record(client.get(client.key('users', user_id)))
+
+    def get_multi(self, user_ids):
+        client = get_datastore_client()
+        users = client.get_multi([client.key('users', uid) for uid in set(user_ids)])
+        return {u.key.id: to_record(u) for u in users}
+
+    def find_by_sub(self, sub):
+        # Equality query on the indexed sub property instead of a kind scan
+        client = get_datastore_client()
+        query = client.query(kind='users')
+        query.add_filter(filter=PropertyFilter('sub', '=', sub))
+        users = list(query.fetch(limit=1))
+        return to_record(users[0]) if users else None
+
+    def create(self, fields):
+        client = get_datastore_client()
+        key = client.key('users', fields['id']) if fields.get('id') else client.key('users')
+        user = datastore.Entity(key=key, exclude_from_indexes=UNINDEXED['users'])
+        user.update({k: v for k, v in fields.items() if k != 'id'})
+        client.put(user)
+        return to_record(user)
+
+    def list(self, fields=None):
+        client = get_datastore_client()
+        query = client.query(kind='users')
+        if fields is None:
+            return [to_record(u) for u in query.fetch()]
+
+        # Read what's needed from the indexes instead of loading whole users
+        # (avatar metadata, course arrays). A projection only returns users
+        # that have every projected property indexed, which is why the
+        # plain listing above still loads entities.
+        needed = [f for f in ('sub', 'role') if f in fields]
+        if needed:
+            query.projection = needed
+        else:
+            query.keys_only()
+        return [to_record(u) for u in query.fetch()]
+
+    def scan(self, batch_size=BATCH_SIZE):
+        return scan_kind(get_datastore_client(), 'users', batch_size)
+
+    def set_avatar(self, user_id, metadata):
+        # Done in a transaction so concurrent enrollment writes aren't lost
+        client = get_datastore_client()
+        with client.transaction():
+            user = client.get(client.key('users', user_id))
+            if user is None:
+                return
+            user['avatar'] = metadata
+            user.exclude_from_indexes.add('avatar')
+            client.put(user)
+
+
+class DatastoreCourseRepo(CourseRepo):
+    def get(self, course_id):
+        client = get_datastore_client()
+        return to_record(client.get(client.key('courses', course_id)))
+
+    def get_multi(self, course_ids):
+        client = get_datastore_client()
+        courses = client.get_multi([client.key('courses', cid) for cid in set(course_ids)])
+        return {c.key.id: to_record(c) for c in courses}
+
+    def create(self, fields):
+        client = get_datastore_client()
+        course = datastore.Entity(key=client.key('courses'))
+        course.update({field: fields[field] for field in COURSE_FIELDS})
+        client.put(course)  # index all fields by default
+        return to_record(course)
+
+    def create_multi(self, fields_list):
+        # Ids are reserved in one call, so nothing is read back after the writes
+        client = get_datastore_client()
+        keys = client.allocate_ids(client.key('courses'), len(fields_list))
+        courses = []
+        for key, fields in zip(keys, fields_list):
+            course = datastore.Entity(key=key)
+            course.update({field: fields[field] for field in COURSE_FIELDS})
+            courses.append(course)
+        for start in range(0, len(courses), BATCH_SIZE):
+            client.put_multi(courses[start:start + BATCH_SIZE])
+        return [to_record(c) for c in courses]
+
+    def update(self, course_id, fields):
+        client = get_datastore_client()
+        course = client.get(client.key('courses', course_id))
+        for field in COURSE_FIELDS:
+            if field in fields:
+                course[field] = fields[field]
+        client.put(course)
+        return to_record(course)
+
+    def list_page(self, limit, cursor=None, offset=None, filters=None, fields=None):
+        # Each page costs at most `limit` entity reads. Filtered listings
+        # are served by the composite indexes in index.yaml.
+        filters = filters or {}
+        field = sort_field(filters)
+        client = get_datastore_client()
+        # Pages that need only ids and sort values are read from the index
+        # the query runs on, without loading any entity
+        from_index = fields is not None and set(fields) <= {'id', field}
+
+        def run(query, value=None, **kwargs):
+            if not from_index:
+                return [to_record(c) for c in query.fetch(**kwargs)]
+            # Properties under an equality filter can't be projected, but
+            # then their value is already known
+            if value is None:
+                value = filters.get(field)
+            if value is None:
+                query.projection = [field]
+                return [to_record(c) for c in query.fetch(**kwargs)]
+            query.keys_only()
+            return [{"id": c.key.id, field: value} for c in query.fetch(**kwargs)]
+
+        def query(order, ranges=True):
+            query = client.query(kind='courses', order=order)
+            for name in FILTER_FIELDS:
+                if name in filters:
+                    query.add_filter(filter=PropertyFilter(name, '=', filters[name]))
+            if ranges and 'number_min' in filters:
+                query.add_filter(filter=PropertyFilter('number', '>=', filters['number_min']))
+            if ranges and 'number_max' in filters:
+                query.add_filter(filter=PropertyFilter('number', '<=', filters['number_max']))
+            return query
+
+        if offset is not None:
+            return run(query([field, '__key__']), limit=limit, offset=offset)
+
+        if cursor is None:
+            return run(query([field, '__key__']), limit=limit)
+
+        value, course_id = cursor
+
+        # Remaining courses with the same sort value as the cursor...
+        same = query(['__key__'], ranges=False)
+        same.add_filter(filter=PropertyFilter(field, '=', value))
+        same.add_filter(filter=PropertyFilter('__key__', '>', client.key('courses', course_id)))
+        courses = run(same, value, limit=limit)
+
+        # ...followed by the courses with later values
+        if len(courses) < limit and field not in filters:
+            later = query([field, '__key__'])
+            later.add_filter(filter=PropertyFilter(field, '>', value))
+            courses += run(later, limit=limit - len(courses))
+        return courses
+
+    def ids_for_instructor(self, user_id):
+        client = get_datastore_client()
+        query = client.query(kind='courses')
+        query.add_filter(filter=PropertyFilter('instructor_id', '=', user_id))
+        query.keys_only()
+        return [c.key.id for c in query.fetch()]
+
+    def scan(self, batch_size=BATCH_SIZE):
+        # Tombstones can't be filtered out in the query (live courses have
+        # no `deleted` property), so they are dropped here
+        for batch in scan_kind(get_datastore_client(), 'courses', batch_size):
+            live = [c for c in batch if not c.get('deleted')]
+            if live:
+                yield live
+
+    def tombstone(self, course_id):
+        client = get_datastore_client()
+        # Roster snapshot for the cleanup job, which deletes the enrollments.
+        # Roster writes committed after it are caught by the job's own
+        # query; once the tombstone commits, apply() refuses new ones.
+        removed_students = sorted(sid for _, sid in enrolled(client, 'course_id', course_id))
+        with client.transaction():
+            course = client.get(client.key('courses', course_id))
+            course['deleted'] = True
+            course['removed_instructor_id'] = course.get('instructor_id')
+            course['removed_students'] = removed_students
+            course['instructor_id'] = None
+            # Unindexed, the tombstone drops out of every listing query, so
+            # reads served from indexes alone never see it
+            course.exclude_from_indexes.update(UNINDEXED['courses'])
+            course.exclude_from_indexes.update(COURSE_FIELDS)
+            client.put(course)
+        return to_record(course)
+
+    def delete(self, course_id):
+        client = get_datastore_client()
+        client.delete(client.key('courses', course_id))
+
+
+class DatastoreEnrollmentRepo(EnrollmentRepo):
+    # One `enrollments` entity per course/student pair, keyed
+    # "{course_id}:{student_id}" and queried by either id. Roster changes
+    # write only these small entities, never the course or the student, so
+    # concurrent edits to one course don't contend on a single entity.
+
+    def students_of(self, course_id, course=None):
+        client = get_datastore_client()
+        return sorted(sid for _, sid in enrolled(client, 'course_id', course_id))
+
+    def courses_of(self, student_id):
+        client = get_datastore_client()
+        course_ids = sorted(cid for cid, _ in enrolled(client, 'student_id', student_id))
+        if not course_ids:
+            return []
+        # A tombstoned course keeps its enrollments until its cleanup job runs
+        courses = client.get_multi([client.key('courses', cid) for cid in course_ids])
+        live = {c.key.id for c in courses if not c.get('deleted')}
+        return [cid for cid in course_ids if cid in live]
+
+    def rosters(self, courses):
+        # One keys-only IN query per IN_FILTER_SIZE courses
+        client = get_datastore_client()
+        ids = [c['id'] for c in courses]
+        result = {cid: [] for cid in ids}
+        for start in range(0, len(ids), IN_FILTER_SIZE):
+            for course_id, student_id in enrolled(client, 'course_id', ids[start:start + IN_FILTER_SIZE]):
+                result[course_id].append(student_id)
+        for student_ids in result.values():
+            student_ids.sort()
+        return result
+
+    def apply(self, changes, courses=None, students=None):
+        # Adds and removes are blind writes by key, and repeating a change
+        # is harmless. The only read is of the courses themselves.
+        client = get_datastore_client()
+        mutations = []
+        for course_id, (add_ids, remove_ids) in changes.items():
+            for sid in add_ids:
+                enrollment = datastore.Entity(key=enrollment_key(client, course_id, sid))
+                enrollment.update({"course_id": course_id, "student_id": sid})
+                mutations.append((course_id, 'put', enrollment))
+            mutations += [(course_id, 'delete', enrollment_key(client, course_id, sid)) for sid in remove_ids]
+
+        # Each batch is applied atomically, together with a read of its
+        # courses: a tombstone committed first fails the batch, and one
+        # committed meanwhile conflicts with it. Batches already committed
+        # are left for the cleanup job, which re-queries the enrollments.
+        for start in range(0, len(mutations), BATCH_SIZE):
+            batch = mutations[start:start + BATCH_SIZE]
+            course_ids = sorted({course_id for course_id, _, _ in batch})
+            with client.transaction():
+                found = client.get_multi([client.key('courses', cid) for cid in course_ids])
+                if len(found) != len(course_ids) or any(c.get('deleted') for c in found):
+                    raise CourseDeleted(course_ids)
+                client.put_multi([m for _, op, m in batch if op == 'put'])
+                client.delete_multi([m for _, op, m in batch if op == 'delete'])
+
+    def unlink_course(self, course_id, user_ids):
+        # Delete the course's enrollments for these users (the instructor
+        # has none, which is harmless)
+        client = get_datastore_client()
+        client.delete_multi([enrollment_key(client, course_id, uid) for uid in user_ids])
+
+
+class GCSAvatarStore(AvatarStore):
+    supports_signed_urls = True
+
+    def __init__(self, bucket_name=BUCKET_NAME):
+        self.bucket_name = bucket_name
+
+    def is_configured(self):
+        return bool(self.bucket_name)
+
+    def bucket(self):
+        return get_bucket(self.bucket_name)
+
+    def serve(self, user_id, name, mimetype, generation=None):
+        return stream_avatar(self.bucket(), user_id, name, mimetype, generation)
+
+    def redirect(self, name):
+        return redirect_to_avatar(self.bucket(), name)
+
+    def save(self, user_id, stream):
+        return process_and_upload_avatar(gcs_writer(self.bucket()), user_id, stream)
+
+    def delete(self, user_id):
+        return delete_avatar_blobs(self.bucket(), user_id)
+
+    def signed_upload(self, user_id, content_type):
+        return signed_upload(self.bucket(), user_id, content_type)
+
+    def process_staged(self, user_id):
+        try:
+            return process_staged_upload(self.bucket(), user_id)
+        except NotFound:
+            raise MissingUpload(user_id)
+
+    def invalidate(self, user_id):
+        invalidate_avatar(user_id)
@@ -0,0 +1,286 @@
+# repositories/memory.py
+#
+# In-process backend for local development, tests and benchmarks. Data
+# lives in the worker's memory, so each gunicorn worker has its own copy.
+import io
+import copy
+import time
+import bisect
+import datetime
+import threading
+from collections import namedtuple
+from flask import jsonify
+from avatars import (send_avatar, all_avatar_blob_names,
+                     process_and_upload_avatar, staged_blob_name)
+from repositories.base import (UserRepo, CourseRepo, EnrollmentRepo, AvatarStore,
+                               MissingUpload, CourseDeleted, COURSE_FIELDS, BATCH_SIZE,
+                               sort_field, sort_value, matches_filters)
+
+# An avatar image held outside GCS, with the fields avatar_metadata() reads
+StoredObject = namedtuple('StoredObject', ['generation', 'size', 'content_type', 'updated', 'data'])
+
+
+def stored_object(data, content_type):
+    return StoredObject(time.time_ns() // 1000, len(data), content_type,
+                        datetime.datetime.now(datetime.timezone.utc), data)
+
+
+class MemoryStore:
+    # The tables and secondary indexes shared by the memory repositories
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}
+        self.subs = {}                # sub -> user id
+        self.courses = {}
+        self.order = []               # sorted (sort_value(subject), id) of live courses
+        self.by_instructor = {}       # user id -> set of course ids
+        self.rosters = {}             # course id -> set of student ids
+        self.by_student = {}          # student id -> set of course ids
+        self.objects = {}             # avatar blob name -> StoredObject
+        self.next_id = 1
+
+    def allocate_id(self):
+        with self.lock:
+            new_id = self.next_id
+            self.next_id += 1
+            return new_id
+
+    def index_course(self, course):
+        bisect.insort(self.order, (sort_value(course['subject']), course['id']))
+        self.by_instructor.setdefault(course['instructor_id'], set()).add(course['id'])
+
+    def unindex_course(self, course):
+        entry = (sort_value(course['subject']), course['id'])
+        position = bisect.bisect_left(self.order, entry)
+        if position < len(self.order) and self.order[position] == entry:
+            del self.order[position]
+        self.by_instructor.get(course['instructor_id'], set()).discard(course['id'])
+
+
+class MemoryUserRepo(UserRepo):
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, user_id):
+        with self.store.lock:
+            return copy.deepcopy(self.store.users.get(user_id))
+
+    def get_multi(self, user_ids):
+        with self.store.lock:
+            return {uid: copy.deepcopy(self.store.users[uid])
+                    for uid in set(user_ids) if uid in self.store.users}
+
+    def find_by_sub(self, sub):
+        with self.store.lock:
+            return self.get(self.store.subs.get(sub))
+
+    def create(self, fields):
+        with self.store.lock:
+            user_id = fields.get('id') or self.store.allocate_id()
+            self.store.next_id = max(self.store.next_id, user_id + 1)
+            user = dict(copy.deepcopy(fields), id=user_id)
+            self.store.users[user_id] = user
+            self.store.subs[user['sub']] = user_id
+            return copy.deepcopy(user)
+
+    def list(self, fields=None):
+        with self.store.lock:
+            return [copy.deepcopy(u) for u in self.store.users.values()]
+
+    def scan(self, batch_size=BATCH_SIZE):
+        with self.store.lock:
+            ids = sorted(self.store.users)
+        for start in range(0, len(ids), batch_size):
+            batch = list(self.get_multi(ids[start:start + batch_size]).values())
+            if batch:
+                yield sorted(batch, key=lambda u: u['id'])
+
+    def set_avatar(self, user_id, metadata):
+        with self.store.lock:
+            if user_id in self.store.users:
+                self.store.users[user_id]['avatar'] = copy.deepcopy(metadata)
+
+
+class MemoryCourseRepo(CourseRepo):
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, course_id):
+        with self.store.lock:
+            return copy.deepcopy(self.store.courses.get(course_id))
+
+    def get_multi(self, course_ids):
+        with self.store.lock:
+            return {cid: copy.deepcopy(self.store.courses[cid])
+                    for cid in set(course_ids) if cid in self.store.courses}
+
+    def create(self, fields):
+        with self.store.lock:
+            course = {field: fields[field] for field in COURSE_FIELDS}
+            course['id'] = self.store.allocate_id()
+            self.store.courses[course['id']] = course
+            self.store.rosters[course['id']] = set()
+            self.store.index_course(course)
+            return copy.deepcopy(course)
+
+    def create_multi(self, fields_list):
+        with self.store.lock:
+            return [self.create(fields) for fields in fields_list]
+
+    def update(self, course_id, fields):
+        with self.store.lock:
+            course = self.store.courses[course_id]
+            self.store.unindex_course(course)
+            for field in COURSE_FIELDS:
+                if field in fields:
+                    course[field] = fields[field]
+            self.store.index_course(course)
+            return copy.deepcopy(course)
+
+    def list_page(self, limit, cursor=None, offset=None, filters=None, fields=None):
+        # Walks the sorted (subject, id) index, so a page costs O(log n + limit).
+        # Filtered listings scan every course.
+        with self.store.lock:
+            order = self.store.order
+            if filters:
+                field = sort_field(filters)
+                order = sorted((sort_value(c[field]), c['id']) for c in self.store.courses.values()
+                               if not c.get('deleted') and matches_filters(c, filters))
+            if offset is not None:
+                start = offset
+            elif cursor is not None:
+                start = bisect.bisect_right(order, (sort_value(cursor[0]), cursor[1]))
+            else:
+                start = 0
+            return [copy.deepcopy(self.store.courses[cid]) for _, cid in order[start:start + limit]]
+
+    def ids_for_instructor(self, user_id):
+        with self.store.lock:
+            return sorted(self.store.by_instructor.get(user_id, ()))
+
+    def scan(self, batch_size=BATCH_SIZE):
+        with self.store.lock:
+            ids = sorted(self.store.courses)
+        for start in range(0, len(ids), batch_size):
+            courses = self.get_multi(ids[start:start + batch_size]).values()
+            batch = sorted((c for c in courses if not c.get('deleted')), key=lambda c: c['id'])
+            if batch:
+                yield batch
+
+    def tombstone(self, course_id):
+        with self.store.lock:
+            course = self.store.courses[course_id]
+            self.store.unindex_course(course)
+            students = self.store.rosters.pop(course_id, set())
+            for sid in students:
+                self.store.by_student.get(sid, set()).discard(course_id)
+            course.update({
+                "deleted": True,
+                "removed_instructor_id": course.get('instructor_id'),
+                "removed_students": sorted(students),
+                "instructor_id": None
+            })
+            return copy.deepcopy(course)
+
+    def delete(self, course_id):
+        with self.store.lock:
+            course = self.store.courses.get(course_id)
+            if course is not None and not course.get('deleted'):
+                self.tombstone(course_id)
+            self.store.courses.pop(course_id, None)
+
+
+class MemoryEnrollmentRepo(EnrollmentRepo):
+    # Rosters and their reverse index are plain sets, so there are no
+    # per-student mirrors to keep in sync
+
+    def __init__(self, store):
+        self.store = store
+
+    def students_of(self, course_id, course=None):
+        with self.store.lock:
+            return sorted(self.store.rosters.get(course_id, ()))
+
+    def courses_of(self, student_id):
+        with self.store.lock:
+            return sorted(self.store.by_student.get(student_id, ()))
+
+    def apply(self, changes, courses=None, students=None):
+        with self.store.lock:
+            # Checked under the lock tombstone() takes, before any write
+            for course_id in changes:
+                course = self.store.courses.get(course_id)
+                if course is None or course.get('deleted'):
+                    raise CourseDeleted(course_id)
+            for course_id, (add_ids, remove_ids) in changes.items():
+                roster = self.store.rosters.setdefault(course_id, set())
+                roster.update(add_ids)
+                roster.difference_update(remove_ids)
+                for sid in add_ids:
+                    self.store.by_student.setdefault(sid, set()).add(course_id)
+                for sid in remove_ids:
+                    self.store.by_student.get(sid, set()).discard(course_id)
+
+    def unlink_course(self, course_id, user_ids):
+        # Links were dropped when the course was tombstoned
+        pass
+
+
+class LocalAvatarStore(AvatarStore):
+    # Avatar storage for backends without GCS. Subclasses provide
+    # read/write/remove of StoredObjects by blob name.
+
+    def read(self, name):
+        raise NotImplementedError
+
+    def write(self, name, data, content_type):
+        raise NotImplementedError
+
+    def remove(self, name):
+        raise NotImplementedError
+
+    def serve(self, user_id, name, mimetype, generation=None):
+        stored = self.read(name)
+        if stored is None:
+            return jsonify({"Error": "Not found"}), 404
+        return send_avatar(io.BytesIO(stored.data), user_id, mimetype, stored.generation)
+
+    def redirect(self, name):
+        raise NotImplementedError("signed URLs need the GCS avatar store")
+
+    def save(self, user_id, stream):
+        return process_and_upload_avatar(self.write, user_id, stream)
+
+    def delete(self, user_id):
+        results = [self.remove(name) for name in all_avatar_blob_names(user_id)]
+        return results[0]
+
+    def signed_upload(self, user_id, content_type):
+        raise NotImplementedError("signed URLs need the GCS avatar store")
+
+    def process_staged(self, user_id):
+        stored = self.read(staged_blob_name(user_id))
+        if stored is None:
+            raise MissingUpload(user_id)
+        metadata = self.save(user_id, io.BytesIO(stored.data))
+        self.remove(staged_blob_name(user_id))
+        return metadata
+
+
+class MemoryAvatarStore(LocalAvatarStore):
+    def __init__(self, store):
+        self.store = store
+
+    def read(self, name):
+        with self.store.lock:
+            return self.store.objects.get(name)
+
+    def write(self, name, data, content_type):
+        stored = stored_object(data, content_type)
+        with self.store.lock:
+            self.store.objects[name] = stored
+        return stored
+
+    def remove(self, name):
+        with self.store.lock:
+            return self.store.objects.pop(name, None) is not None
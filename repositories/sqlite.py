@@ -0,0 +1,339 @@
+# repositories/sqlite.py
+#
+# Single-file SQLite backend for running the API without Google Cloud.
+# Every access path the handlers use is backed by an index; enrollments
+# are a join table instead of mirrored arrays.
+import os
+import json
+import sqlite3
+import threading
+from repositories.base import (UserRepo, CourseRepo, EnrollmentRepo, CourseDeleted, COURSE_FIELDS,
+                               BATCH_SIZE, FILTER_FIELDS, sort_field)
+from repositories.memory import LocalAvatarStore, StoredObject, stored_object
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "tarpaulin.db")
+SQLITE_TIMEOUT = float(os.getenv("SQLITE_TIMEOUT", "5"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    sub TEXT NOT NULL UNIQUE,
+    role TEXT NOT NULL,
+    avatar TEXT
+);
+CREATE TABLE IF NOT EXISTS courses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject TEXT NOT NULL,
+    number INTEGER,
+    title TEXT,
+    term TEXT,
+    instructor_id INTEGER,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    removed_instructor_id INTEGER,
+    removed_students TEXT
+);
+-- Keyset pagination over live courses
+CREATE INDEX IF NOT EXISTS courses_by_subject ON courses (subject, id) WHERE deleted = 0;
+CREATE INDEX IF NOT EXISTS courses_by_instructor ON courses (instructor_id);
+-- Filtered listings (GET /courses?term=...&number_min=...)
+CREATE INDEX IF NOT EXISTS courses_by_term ON courses (term, subject, id) WHERE deleted = 0;
+CREATE INDEX IF NOT EXISTS courses_by_number ON courses (number, id) WHERE deleted = 0;
+CREATE TABLE IF NOT EXISTS enrollments (
+    course_id INTEGER NOT NULL,
+    student_id INTEGER NOT NULL,
+    PRIMARY KEY (course_id, student_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS enrollments_by_student ON enrollments (student_id, course_id);
+CREATE TABLE IF NOT EXISTS avatar_objects (
+    name TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL,
+    content_type TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+"""
+
+COURSE_COLUMNS = 'id, subject, number, title, term, instructor_id, deleted, ' \
+                 'removed_instructor_id, removed_students'
+
+
+class SQLiteDatabase:
+    # One connection per thread, reopened in forked children
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._reset()
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def connect(self):
+        if self._pid != os.getpid():
+            self._reset()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+
+def user_record(row):
+    if row is None:
+        return None
+    record = dict(row)
+    record['avatar'] = json.loads(record['avatar']) if record['avatar'] else None
+    return record
+
+
+def course_record(row):
+    if row is None:
+        return None
+    record = dict(row)
+    record['deleted'] = bool(record['deleted'])
+    record['removed_students'] = json.loads(record['removed_students'] or '[]')
+    return record
+
+
+def placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+class SQLiteUserRepo(UserRepo):
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, user_id):
+        row = self.db.connect().execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+        return user_record(row)
+
+    def get_multi(self, user_ids):
+        ids = list(set(user_ids))
+        rows = self.db.connect().execute(
+            f'SELECT * FROM users WHERE id IN ({placeholders(ids)})', ids).fetchall()
+        return {row['id']: user_record(row) for row in rows}
+
+    def find_by_sub(self, sub):
+        row = self.db.connect().execute('SELECT * FROM users WHERE sub = ?', (sub,)).fetchone()
+        return user_record(row)
+
+    def create(self, fields):
+        conn = self.db.connect()
+        with conn:
+            cursor = conn.execute('INSERT INTO users (id, sub, role) VALUES (?, ?, ?)',
+                                  (fields.get('id'), fields['sub'], fields['role']))
+        return self.get(cursor.lastrowid)
+
+    def list(self, fields=None):
+        if fields is None:
+            rows = self.db.connect().execute('SELECT * FROM users ORDER BY id').fetchall()
+            return [user_record(row) for row in rows]
+        columns = ['id'] + [f for f in ('sub', 'role') if f in fields]
+        rows = self.db.connect().execute(f'SELECT {", ".join(columns)} FROM users ORDER BY id').fetchall()
+        return [dict(row) for row in rows]
+
+    def scan(self, batch_size=BATCH_SIZE):
+        last_id = 0
+        while True:
+            rows = self.db.connect().execute(
+                'SELECT * FROM users WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size)).fetchall()
+            if rows:
+                yield [user_record(row) for row in rows]
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1]['id']
+
+    def set_avatar(self, user_id, metadata):
+        conn = self.db.connect()
+        with conn:
+            conn.execute('UPDATE users SET avatar = ? WHERE id = ?',
+                         (json.dumps(metadata, default=str) if metadata else None, user_id))
+
+
+class SQLiteCourseRepo(CourseRepo):
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, course_id):
+        row = self.db.connect().execute(
+            f'SELECT {COURSE_COLUMNS} FROM courses WHERE id = ?', (course_id,)).fetchone()
+        return course_record(row)
+
+    def get_multi(self, course_ids):
+        ids = list(set(course_ids))
+        rows = self.db.connect().execute(
+            f'SELECT {COURSE_COLUMNS} FROM courses WHERE id IN ({placeholders(ids)})', ids).fetchall()
+        return {row['id']: course_record(row) for row in rows}
+
+    def create(self, fields):
+        conn = self.db.connect()
+        with conn:
+            cursor = conn.execute(
+                f'INSERT INTO courses ({", ".join(COURSE_FIELDS)}) VALUES ({placeholders(COURSE_FIELDS)})',
+                [fields[field] for field in COURSE_FIELDS])
+        return self.get(cursor.lastrowid)
+
+    def create_multi(self, fields_list):
+        # One transaction for the batch
+        conn = self.db.connect()
+        ids = []
+        with conn:
+            for fields in fields_list:
+                cursor = conn.execute(
+                    f'INSERT INTO courses ({", ".join(COURSE_FIELDS)}) VALUES ({placeholders(COURSE_FIELDS)})',
+                    [fields[field] for field in COURSE_FIELDS])
+                ids.append(cursor.lastrowid)
+        courses = self.get_multi(ids)
+        return [courses[cid] for cid in ids]
+
+    def update(self, course_id, fields):
+        columns = [field for field in COURSE_FIELDS if field in fields]
+        if columns:
+            conn = self.db.connect()
+            with conn:
+                conn.execute(
+                    f'UPDATE courses SET {", ".join(f"{c} = ?" for c in columns)} WHERE id = ?',
+                    [fields[c] for c in columns] + [course_id])
+        return self.get(course_id)
+
+    def list_page(self, limit, cursor=None, offset=None, filters=None, fields=None):
+        # Unfiltered pages are served from courses_by_subject in every mode
+        filters = filters or {}
+        field = sort_field(filters)
+        where, params = ['deleted = 0'], []
+        for name in FILTER_FIELDS:
+            if name in filters:
+                where.append(f'{name} = ?')
+                params.append(filters[name])
+        if 'number_min' in filters:
+            where.append('number >= ?')
+            params.append(filters['number_min'])
+        if 'number_max' in filters:
+            where.append('number <= ?')
+            params.append(filters['number_max'])
+        if cursor is not None and offset is None:
+            where.append(f'({field}, id) > (?, ?)')
+            params += [cursor[0], cursor[1]]
+        rows = self.db.connect().execute(
+            f'SELECT {COURSE_COLUMNS} FROM courses WHERE {" AND ".join(where)} '
+            f'ORDER BY {field}, id LIMIT ? OFFSET ?', params + [limit, offset or 0]).fetchall()
+        return [course_record(row) for row in rows]
+
+    def ids_for_instructor(self, user_id):
+        rows = self.db.connect().execute(
+            'SELECT id FROM courses WHERE instructor_id = ? AND deleted = 0 ORDER BY id',
+            (user_id,)).fetchall()
+        return [row['id'] for row in rows]
+
+    def scan(self, batch_size=BATCH_SIZE):
+        # Keyset pages over the primary key
+        last_id = 0
+        while True:
+            rows = self.db.connect().execute(
+                f'SELECT {COURSE_COLUMNS} FROM courses WHERE id > ? AND deleted = 0 ORDER BY id LIMIT ?',
+                (last_id, batch_size)).fetchall()
+            if rows:
+                yield [course_record(row) for row in rows]
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1]['id']
+
+    def tombstone(self, course_id):
+        # Rosters are dropped in the same transaction, so there is nothing
+        # left for the background cleanup but the final delete
+        conn = self.db.connect()
+        with conn:
+            rows = conn.execute('SELECT student_id FROM enrollments WHERE course_id = ? '
+                                'ORDER BY student_id', (course_id,)).fetchall()
+            conn.execute(
+                'UPDATE courses SET deleted = 1, removed_instructor_id = instructor_id, '
+                'instructor_id = NULL, removed_students = ? WHERE id = ?',
+                (json.dumps([row['student_id'] for row in rows]), course_id))
+            conn.execute('DELETE FROM enrollments WHERE course_id = ?', (course_id,))
+        return self.get(course_id)
+
+    def delete(self, course_id):
+        conn = self.db.connect()
+        with conn:
+            conn.execute('DELETE FROM enrollments WHERE course_id = ?', (course_id,))
+            conn.execute('DELETE FROM courses WHERE id = ?', (course_id,))
+
+
+class SQLiteEnrollmentRepo(EnrollmentRepo):
+    def __init__(self, db):
+        self.db = db
+
+    def students_of(self, course_id, course=None):
+        rows = self.db.connect().execute(
+            'SELECT student_id FROM enrollments WHERE course_id = ? ORDER BY student_id',
+            (course_id,)).fetchall()
+        return [row['student_id'] for row in rows]
+
+    def courses_of(self, student_id):
+        rows = self.db.connect().execute(
+            'SELECT course_id FROM enrollments WHERE student_id = ? ORDER BY course_id',
+            (student_id,)).fetchall()
+        return [row['course_id'] for row in rows]
+
+    def rosters(self, courses):
+        # One query for the whole batch, served by the primary key
+        ids = [c['id'] for c in courses]
+        result = {cid: [] for cid in ids}
+        rows = self.db.connect().execute(
+            f'SELECT course_id, student_id FROM enrollments WHERE course_id IN ({placeholders(ids)}) '
+            'ORDER BY course_id, student_id', ids).fetchall()
+        for row in rows:
+            result[row['course_id']].append(row['student_id'])
+        return result
+
+    def apply(self, changes, courses=None, students=None):
+        # One transaction for the whole change set. The courses are checked
+        # after the writes, once the transaction holds the write lock, so a
+        # tombstone can't commit in between; a deleted course rolls it back.
+        conn = self.db.connect()
+        ids = list(changes)
+        with conn:
+            for course_id, (add_ids, remove_ids) in changes.items():
+                conn.executemany('INSERT OR IGNORE INTO enrollments (course_id, student_id) VALUES (?, ?)',
+                                 [(course_id, sid) for sid in add_ids])
+                conn.executemany('DELETE FROM enrollments WHERE course_id = ? AND student_id = ?',
+                                 [(course_id, sid) for sid in remove_ids])
+            live = conn.execute(f'SELECT COUNT(*) FROM courses WHERE id IN ({placeholders(ids)}) AND deleted = 0',
+                                ids).fetchone()[0]
+            if live != len(ids):
+                raise CourseDeleted(ids)
+
+    def unlink_course(self, course_id, user_ids):
+        # Enrollment rows went away with the tombstone
+        pass
+
+
+class SQLiteAvatarStore(LocalAvatarStore):
+    def __init__(self, db):
+        self.db = db
+
+    def read(self, name):
+        row = self.db.connect().execute(
+            'SELECT generation, length(data) AS size, content_type, updated, data '
+            'FROM avatar_objects WHERE name = ?', (name,)).fetchone()
+        return StoredObject(*row) if row else None
+
+    def write(self, name, data, content_type):
+        stored = stored_object(data, content_type)
+        conn = self.db.connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO avatar_objects (name, generation, content_type, updated, data) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (name, stored.generation, content_type, stored.updated.isoformat(), data))
+        return stored
+
+    def remove(self, name):
+        conn = self.db.connect()
+        with conn:
+            return conn.execute('DELETE FROM avatar_objects WHERE name = ?', (name,)).rowcount > 0
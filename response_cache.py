@@ -0,0 +1,165 @@
+# response_cache.py
+import os
+import json
+import time
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from flask import current_app, request
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "60"))
+# max-age advertised to browsers and CDNs
+RESPONSE_CACHE_MAX_AGE = int(os.getenv("RESPONSE_CACHE_MAX_AGE", "30"))
+# Optional shared backend, e.g. redis://host:6379/0
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL")
+
+
+class MemoryBackend:
+    # In-process LRU with per-entry TTL for cached responses
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class TagVersions:
+    # Tag versions for a single worker. Kept apart from the LRU: a version
+    # that was evicted would restart at 0 and make entries cached before
+    # the invalidation reachable again. One counter per tag, never dropped.
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._versions.get(key)
+
+    def incr(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+
+class RedisBackend:
+    # Shared across workers and instances; needs the optional redis package
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._redis.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(key, json.dumps(value), ex=ttl)
+
+    def incr(self, key):
+        return self._redis.incr(key)
+
+
+class ResponseCache:
+    # Caches successful GET responses keyed by route, host and normalized
+    # query string. Each entry belongs to tags (e.g. "course:5"); bumping a
+    # tag's version makes every entry under it unreachable, which is how
+    # writes invalidate precisely without enumerating keys.
+    def __init__(self, local, shared=None, ttl=RESPONSE_CACHE_TTL,
+                 max_age=RESPONSE_CACHE_MAX_AGE):
+        self.local = local
+        self.shared = shared
+        self.tags = TagVersions()
+        self.ttl = ttl
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    def _versions(self):
+        # Tag versions must be shared for invalidation to reach other workers.
+        # Redis keeps them without a TTL, so they aren't expired either.
+        return self.shared or self.tags
+
+    def version(self, tag):
+        return self._versions().get(f"tag:{tag}") or 0
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self._versions().incr(f"tag:{tag}")
+
+    def _key(self, tags):
+        args = sorted((k, v) for k in request.args for v in request.args.getlist(k))
+        versions = [f"{tag}@{self.version(tag)}" for tag in tags]
+        raw = json.dumps([request.path, request.host_url, args, versions])
+        return "resp:" + hashlib.sha256(raw.encode()).hexdigest()
+
+    def _lookup(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry, self.ttl)
+        return entry
+
+    def _store(self, key, entry):
+        self.local.set(key, entry, self.ttl)
+        if self.shared is not None:
+            self.shared.set(key, entry, self.ttl)
+
+    def cached(self, *tags):
+        # Decorator; tags may use the view's URL arguments, e.g.
+        # @response_cache.cached('course:{course_id}')
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                key = self._key([tag.format(**kwargs) for tag in tags])
+                entry = self._lookup(key)
+                if entry is None:
+                    self.misses += 1
+                    rv = current_app.make_response(view(**kwargs))
+                    if rv.status_code != 200:
+                        return rv
+                    body = rv.get_data()
+                    entry = {
+                        "body": body.decode(),
+                        "mimetype": rv.mimetype,
+                        "etag": hashlib.sha256(body).hexdigest()[:32]
+                    }
+                    self._store(key, entry)
+                else:
+                    self.hits += 1
+
+                rv = current_app.response_class(entry["body"], mimetype=entry["mimetype"])
+                rv.set_etag(entry["etag"])
+                rv.cache_control.public = True
+                rv.cache_control.max_age = self.max_age
+                return rv.make_conditional(request)
+            return wrapper
+        return decorator
+
+
+def make_response_cache():
+    shared = RedisBackend(RESPONSE_CACHE_URL) if RESPONSE_CACHE_URL else None
+    return ResponseCache(MemoryBackend(), shared)
+
+
+response_cache = make_response_cache()
@@ -0,0 +1,267 @@
+# search.py
+#
+# In-process inverted index over the public course fields, serving q=
+# searches and facet counts on GET /courses without touching storage.
+# Each worker builds it from storage on start and applies its own writes
+# as they happen. Writes made by other workers show up when the index is
+# rebuilt, SEARCH_INDEX_TTL seconds after the last build.
+import os
+import re
+import time
+import bisect
+import logging
+import threading
+from collections import Counter
+from repositories import (get_repositories, matches_filters, sort_field, sort_value,
+                          COURSE_FIELDS, FILTER_FIELDS)
+
+SEARCH_INDEX_TTL = float(os.getenv("SEARCH_INDEX_TTL", "60"))
+
+# Fields counted in the facets of a listing (?facets=1)
+FACET_FIELDS = ('term', 'subject')
+
+TOKEN_RE = re.compile(r'[^\W_]+')
+
+logger = logging.getLogger(__name__)
+
+
+def tokenize(text):
+    if text is None:
+        return []
+    return TOKEN_RE.findall(str(text).lower())
+
+
+def doc_tokens(doc):
+    # Searchable words of a course: its subject, number and title
+    return set(tokenize(doc['subject'])) | set(tokenize(doc['number'])) | set(tokenize(doc['title']))
+
+
+def _hashable(value):
+    # Stored values are JSON; anything unhashable is looked up by its text
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return str(value)
+
+
+class _Postings:
+    # One generation of the index: documents, token -> ids, the sorted
+    # token list used for prefix lookups, ids per value of each filter
+    # field, the sorted (number, id) list for number ranges and the
+    # per-value course counts behind unfiltered facets
+    def __init__(self):
+        self.docs = {}
+        self.postings = {}
+        self.tokens = []
+        self.by_value = {field: {} for field in FILTER_FIELDS}
+        self.numbers = []
+        self.counts = {field: Counter() for field in FACET_FIELDS}
+
+    def add(self, course, sort_tokens=True):
+        self.remove(course['id'])
+        doc = {f: course.get(f) for f in ['id'] + COURSE_FIELDS}
+        self.docs[doc['id']] = doc
+        for token in doc_tokens(doc):
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = set()
+                if sort_tokens:
+                    bisect.insort(self.tokens, token)
+            ids.add(doc['id'])
+        for field, values in self.by_value.items():
+            values.setdefault(_hashable(doc[field]), set()).add(doc['id'])
+        if _is_number(doc['number']):
+            if sort_tokens:
+                bisect.insort(self.numbers, (doc['number'], doc['id']))
+            else:
+                self.numbers.append((doc['number'], doc['id']))
+        for field, counts in self.counts.items():
+            counts[_hashable(doc[field])] += 1
+
+    def remove(self, course_id):
+        doc = self.docs.pop(course_id, None)
+        if doc is None:
+            return
+        for field, values in self.by_value.items():
+            value = _hashable(doc[field])
+            ids = values.get(value)
+            if ids is not None:
+                ids.discard(course_id)
+                if not ids:
+                    del values[value]
+        if _is_number(doc['number']):
+            position = bisect.bisect_left(self.numbers, (doc['number'], course_id))
+            if position < len(self.numbers) and self.numbers[position] == (doc['number'], course_id):
+                del self.numbers[position]
+        for field, counts in self.counts.items():
+            value = _hashable(doc[field])
+            counts[value] -= 1
+            if counts[value] <= 0:
+                del counts[value]
+        for token in doc_tokens(doc):
+            ids = self.postings.get(token)
+            if ids is None:
+                continue
+            ids.discard(course_id)
+            if not ids:
+                del self.postings[token]
+                position = bisect.bisect_left(self.tokens, token)
+                if position < len(self.tokens) and self.tokens[position] == token:
+                    del self.tokens[position]
+
+    def prefixed(self, prefix):
+        # Ids of courses with a word starting with `prefix`
+        ids = set()
+        position = bisect.bisect_left(self.tokens, prefix)
+        while position < len(self.tokens) and self.tokens[position].startswith(prefix):
+            ids |= self.postings[self.tokens[position]]
+            position += 1
+        return ids
+
+    def match(self, terms):
+        # Every term must prefix some word of the course, so results
+        # narrow as the user types
+        if not terms:
+            return set(self.docs)
+        ids = None
+        for term in sorted(terms, key=len, reverse=True):
+            found = self.prefixed(term)
+            ids = found if ids is None else ids & found
+            if not ids:
+                break
+        return ids
+
+    def filtered(self, filters):
+        # Ids of courses matching `filters`, from the value and number
+        # lists alone; None means no filter narrows the set
+        sets = [self.by_value[f].get(filters[f], set()) for f in FILTER_FIELDS if f in filters]
+        if 'number_min' in filters or 'number_max' in filters:
+            low = bisect.bisect_left(self.numbers, (filters.get('number_min', float('-inf')),))
+            high = bisect.bisect_right(self.numbers, (filters.get('number_max', float('inf')), float('inf')))
+            sets.append({cid for _, cid in self.numbers[low:high]})
+        if not sets:
+            return None
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def facets(self, terms, filters):
+        # {field: Counter} over the courses matching `terms` and `filters`
+        ids = self.filtered(filters)
+        if terms:
+            found = self.match(terms)
+            ids = found if ids is None else ids & found
+        if ids is None:
+            return self.counts
+        return {field: Counter(_hashable(self.docs[cid][field]) for cid in ids)
+                for field in FACET_FIELDS}
+
+
+def _is_number(value):
+    # Number ranges only ever match integers (see matches_filters)
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class CourseIndex:
+    def __init__(self, ttl=SEARCH_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._current = None
+        self._built_at = 0.0
+        self._pending = None   # writes made while a rebuild is running
+        self._ready = threading.Event()
+
+    def load(self):
+        # Build a new generation from storage and swap it in. Writes that
+        # land meanwhile are replayed onto it so none are lost.
+        with self._lock:
+            running = self._pending is not None
+            if not running:
+                self._pending = []
+        if running:
+            # Another thread is building it; only the first build is worth waiting for
+            self._ready.wait(timeout=30)
+            return
+        try:
+            postings = _Postings()
+            for courses in get_repositories().courses.scan():
+                for course in courses:
+                    postings.add(course, sort_tokens=False)
+            postings.tokens = sorted(postings.postings)
+            postings.numbers.sort()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for op, arg in self._pending:
+                postings.add(arg) if op == 'add' else postings.remove(arg)
+            self._pending = None
+            self._current = postings
+            self._built_at = time.monotonic()
+        self._ready.set()
+
+    def _refresh_in_background(self):
+        def run():
+            try:
+                self.load()
+            except Exception:
+                logger.exception("Rebuilding the course search index failed")
+        threading.Thread(target=run, name='course-index', daemon=True).start()
+
+    def _postings(self):
+        # Callers hold the lock. The first search builds the index inline;
+        # after that a stale index keeps serving while it is rebuilt.
+        if self._current is None:
+            self._lock.release()
+            try:
+                self.load()
+            finally:
+                self._lock.acquire()
+        elif self.ttl > 0 and time.monotonic() - self._built_at > self.ttl and self._pending is None:
+            self._built_at = time.monotonic()
+            self._refresh_in_background()
+        return self._current
+
+    def _apply(self, op, arg):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((op, arg))
+            if self._current is not None:
+                self._current.add(arg) if op == 'add' else self._current.remove(arg)
+
+    def add(self, course):
+        # Index a created or updated course
+        self._apply('add', course)
+
+    def remove(self, course_id):
+        self._apply('remove', course_id)
+
+    def search(self, q, filters=None):
+        # Courses matching the words in `q` and `filters`, ordered like a
+        # listing with the same filters
+        filters = filters or {}
+        field = sort_field(filters)
+        with self._lock:
+            postings = self._postings()
+            if postings is None:
+                return []
+            docs = [postings.docs[cid] for cid in postings.match(set(tokenize(q)))]
+            docs = [d for d in docs if matches_filters(d, filters)]
+        # Documents are replaced, never changed, so these stay valid; they
+        # are shared with the index and must not be modified
+        return sorted(docs, key=lambda d: (sort_value(d[field]), d['id']))
+
+    def facets(self, q, filters=None):
+        # {field: {value: count}} over the courses matching `q` and
+        # `filters`, counted from the index without sorting the matches
+        with self._lock:
+            postings = self._postings()
+            if postings is None:
+                return {field: {} for field in FACET_FIELDS}
+            counts = postings.facets(set(tokenize(q)), filters or {})
+            return {field: {str(value): n for value, n in sorted(counts[field].items(), key=lambda kv: str(kv[0]))}
+                    for field in FACET_FIELDS}
+
+
+course_index = CourseIndex()
@@ -1,19 +1,226 @@
 # utils.py
 import os
+import re
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from six.moves.urllib.request import urlopen
-from jose import jwt, JWTError
+from jose import jwk, jwt, JWTError
 from flask import request
+from metrics import timed, record_external, TOKEN_CACHE_EVENTS, TOKEN_CACHE_ENTRIES
 
 AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
 CLIENT_ID = os.getenv("AUTH0_CLIENT_ID")
+# Issuer base URL; overridden to point at a local stand-in (see benchmark/)
+AUTH0_BASE_URL = os.getenv("AUTH0_BASE_URL", f"https://{AUTH0_DOMAIN}").rstrip('/')
 ALGORITHMS = ["RS256"]
 
+# JWKS cache tuning (seconds)
+JWKS_TTL = int(os.getenv("JWKS_TTL", "3600"))
+JWKS_FETCH_TIMEOUT = float(os.getenv("JWKS_FETCH_TIMEOUT", "5"))
+JWKS_REFRESH_MARGIN = int(os.getenv("JWKS_REFRESH_MARGIN", "300"))
+JWKS_MIN_REFETCH_INTERVAL = int(os.getenv("JWKS_MIN_REFETCH_INTERVAL", "30"))
+
+# Verified-token cache tuning
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_MAX_AGE = int(os.getenv("TOKEN_CACHE_MAX_AGE", "300"))
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
         self.status_code = status_code
 
+
+class JWKSCache:
+    # Process-wide store of the Auth0 signing keys, parsed once into
+    # RSA key objects and indexed by kid.
+    def __init__(self, url, ttl=JWKS_TTL, timeout=JWKS_FETCH_TIMEOUT,
+                 refresh_margin=JWKS_REFRESH_MARGIN,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.min_refetch_interval = min_refetch_interval
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._rotate_listeners = []
+
+    def on_rotate(self, callback):
+        # Called with no arguments whenever the set of signing keys changes
+        self._rotate_listeners.append(callback)
+
+    def get_key(self, kid):
+        now = time.monotonic()
+        if not self._keys or now >= self._expires_at:
+            # Nothing usable yet (or fully expired): fetch in the request path
+            self._refresh(stale_ok=bool(self._keys))
+        elif now >= self._expires_at - self.refresh_margin:
+            # Close to expiry: refresh without making this request wait
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and kid and self._may_refetch():
+            # Unknown kid may mean Auth0 rotated its keys; fetch again,
+            # but no more than once per min_refetch_interval
+            self._refresh(stale_ok=True)
+            key = self._keys.get(kid)
+        return key
+
+    def _may_refetch(self):
+        return time.monotonic() - self._last_fetch >= self.min_refetch_interval
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._background_refresh, daemon=True)
+        thread.start()
+
+    def _background_refresh(self):
+        try:
+            self._refresh(stale_ok=True)
+        finally:
+            self._refreshing = False
+
+    def _refresh(self, stale_ok=False):
+        with self._lock:
+            now = time.monotonic()
+            # Another thread may have refreshed while we waited on the lock
+            if self._keys and now < self._expires_at and now - self._last_fetch < self.min_refetch_interval:
+                return
+            self._last_fetch = now
+            try:
+                keys, ttl = self._fetch()
+            except Exception:
+                if not stale_ok:
+                    raise
+                # Keep serving the keys we have and retry after the back-off.
+                # Only ever push the expiry out: keys still valid keep their
+                # lifetime, so a failed unknown-kid refetch can't shorten it.
+                self._expires_at = max(self._expires_at, now + self.min_refetch_interval)
+                return
+            rotated = self._keys and set(keys) != set(self._keys)
+            self._keys = keys
+            self._expires_at = now + ttl
+        if rotated:
+            for callback in self._rotate_listeners:
+                callback()
+
+    def _fetch(self):
+        start = time.perf_counter()
+        resp = urlopen(self.url, timeout=self.timeout)
+        jwks = json.loads(resp.read())
+        record_external('auth0_jwks', time.perf_counter() - start)
+
+        ttl = self.ttl
+        cache_control = resp.headers.get("Cache-Control") or ""
+        match = _MAX_AGE_RE.search(cache_control)
+        if match:
+            ttl = int(match.group(1))
+        if "no-cache" in cache_control or "no-store" in cache_control:
+            ttl = 0
+        ttl = max(ttl, self.min_refetch_interval)
+
+        keys = {}
+        for key in jwks.get("keys", []):
+            if key.get("kty") != "RSA" or key.get("use", "sig") != "sig" or "kid" not in key:
+                continue
+            keys[key["kid"]] = jwk.construct({
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key.get("use", "sig"),
+                "n": key["n"],
+                "e": key["e"]
+            }, algorithm="RS256")
+        return keys, ttl
+
+
+class TokenCache:
+    # Bounded LRU of already-verified tokens. Entries are keyed by a hash
+    # of the raw token and kept until the token's exp (capped by max_age).
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, max_age=TOKEN_CACHE_MAX_AGE):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                TOKEN_CACHE_EVENTS.labels('miss').inc()
+                return None
+            claims, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                TOKEN_CACHE_ENTRIES.dec()
+                self.misses += 1
+                TOKEN_CACHE_EVENTS.labels('miss').inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            TOKEN_CACHE_EVENTS.labels('hit').inc()
+            return claims
+
+    def put(self, token, claims):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.time() + self.max_age
+        if "exp" in claims:
+            expires_at = min(expires_at, float(claims["exp"]))
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (claims, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                TOKEN_CACHE_EVENTS.labels('eviction').inc()
+            TOKEN_CACHE_ENTRIES.set(len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            TOKEN_CACHE_ENTRIES.set(0)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+jwks_cache = JWKSCache(f"{AUTH0_BASE_URL}/.well-known/jwks.json")
+token_cache = TokenCache()
+
+# Tokens verified against keys that have since rotated must be re-checked
+jwks_cache.on_rotate(token_cache.clear)
+
+
+@timed('jwt')
 def verify_jwt(request):
     if 'Authorization' not in request.headers:
         raise AuthError({"code": "unauthorized", "description": "Unauthorized"}, 401)
@@ -24,24 +231,17 @@ def verify_jwt(request):
 
     token = auth_header[1]
 
+    # Skip signature verification for tokens we've already accepted
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     try:
-        jsonurl = urlopen(f"https://{AUTH0_DOMAIN}/.well-known/jwks.json")
-        jwks = json.loads(jsonurl.read())
         unverified_header = jwt.get_unverified_header(token)
+        rsa_key = jwks_cache.get_key(unverified_header.get("kid"))
     except Exception:
         raise AuthError({"code": "unauthorized", "description": "Unauthorized"}, 401)
 
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header.get("kid"):
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
-
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -49,8 +249,9 @@ def verify_jwt(request):
                 rsa_key,
                 algorithms=ALGORITHMS,
                 audience=CLIENT_ID,
-                issuer=f"https://{AUTH0_DOMAIN}/"
+                issuer=f"{AUTH0_BASE_URL}/"
             )
+            token_cache.put(token, payload)
             return payload
         except JWTError:
             raise AuthError({"code": "unauthorized", "description": "Unauthorized"}, 401)